@@ -1,9 +1,20 @@
-import streamlit as st
+import os
 import sqlite3
+import sys
+import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import plotly.express as px
 from datetime import datetime
 
+# The pipeline modules import each other flatly (`from db import ...`)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "processing"))
+from db import (
+    schema_version, SCHEMA_VERSION, search_messages, browse_messages, get_campaigns,
+    get_data_version, get_first_day_after, get_daily_counts, ReadPool,
+)
+
 # ---------------------------------------------------------
 # 0. CONFIGURATION
 # ---------------------------------------------------------
@@ -22,35 +33,152 @@ TYPE_MAPPING = {
 }
 
 DB_NAME = "chat_data.db"
+SNAPSHOT_PATH = "chat_data.rollup.parquet"
+SEARCH_PAGE_SIZE = 50
+BROWSER_PAGE_SIZE = 500
+CAMPAIGN_MIN_REPOSTS = 3
+CAMPAIGN_LIMIT = 50
+POOL_SIZE = 8               # Read-only connections shared by all sessions
+RESULT_CACHE_ENTRIES = 256  # Query results kept across sessions, least recently used dropped first
+VERSION_TTL = 5             # Seconds between two checks of the DB's data_version
 
 # ---------------------------------------------------------
 # 1. DATA LOADING
 # ---------------------------------------------------------
-@st.cache_data
-def load_data():
-    conn = sqlite3.connect(DB_NAME)
-    query = """
-        SELECT m.id, u.ssn as user_ssn, m.timestamp, m.content, m.type
-        FROM messages m JOIN users u ON m.user_id = u.id
-        ORDER BY m.timestamp DESC
+@st.cache_resource
+def read_pool():
+    return ReadPool(DB_NAME, size=POOL_SIZE)
+
+def check_schema():
+    """
+    The dashboard only reads: migrating (which may rebuild indexes and
+    rollups) is left to the ingest/maintenance CLIs. Stops the page if the
+    DB is missing or not at the schema version this code expects.
     """
     try:
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df['content'] = df['content'].fillna("").astype(str)
-        df['user_ssn'] = df['user_ssn'].fillna("Unknown").astype(str)
-
-        # Mapping Logic
-        df['type_raw'] = df['type'].fillna(-1).astype(int)
-        def get_label(x):
-            if x == -1: return "Untagged"
-            return TYPE_MAPPING.get(x, f"Type {x}")
-        df['type'] = df['type_raw'].apply(get_label)
-        
-        return df
-    except Exception:
-        return pd.DataFrame()
+        with read_pool().connection() as conn:
+            found = schema_version(conn)
+    except sqlite3.Error as e:
+        st.error(f"Can't open {DB_NAME} ({e}). Ingest an export first: python processing/split.py cvs.txt")
+        st.stop()
+    if found != SCHEMA_VERSION:
+        st.error(f"{DB_NAME} is at schema version {found}, this dashboard needs version {SCHEMA_VERSION}. "
+                 f"Ask the operator to migrate it: python processing/maintenance.py --db {DB_NAME}")
+        st.stop()
+
+def get_label(x):
+    if x == -1: return "Untagged"
+    return TYPE_MAPPING.get(x, f"Type {x}")
+
+def type_labels(type_raw):
+    """Type codes (-1 = untagged) -> Categorical of labels; get_label runs once per distinct code."""
+    codes, uniques = pd.factorize(type_raw, sort=True)
+    return pd.Categorical.from_codes(codes, [get_label(x) for x in uniques])
+
+def rollup_frame(rows):
+    """(day, type, user_ssn, count) rows -> raw analytics frame (see compact)."""
+    return pd.DataFrame(rows, columns=['day', 'type_raw', 'user_ssn', 'count'])
+
+def compact(rollup):
+    """
+    Analytics frame with fixed-width columns only: user and type labels are
+    categoricals (small integer codes + one copy of each string), day is
+    datetime64 and the numbers are narrow ints.
+    """
+    return pd.DataFrame({
+        'day': pd.to_datetime(rollup['day']),
+        'type_raw': rollup['type_raw'].astype('int8'),
+        'user_ssn': pd.Categorical(rollup['user_ssn'].fillna("Unknown").astype(str)),
+        'count': rollup['count'].astype('int32'),
+        'type': type_labels(rollup['type_raw']),
+    })
+
+def select_codes(column, selected):
+    """Mask of rows of a categorical column whose label is in `selected`, compared on codes."""
+    wanted = column.cat.categories.get_indexer(selected)
+    return column.cat.codes.isin(wanted[wanted >= 0])
+
+def read_snapshot_version():
+    """(data_version, max_id) the Parquet snapshot was built at, or None."""
+    try:
+        meta = pq.read_schema(SNAPSHOT_PATH).metadata or {}
+        return int(meta[b'data_version']), int(meta[b'max_id'])
+    except (OSError, KeyError, ValueError, pa.ArrowInvalid):
+        return None
+
+def write_snapshot(rollup, version):
+    table = pa.Table.from_pandas(rollup, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'data_version': str(version[0]).encode(),
+        b'max_id': str(version[1]).encode(),
+    })
+    # Written aside and renamed, so a concurrent reader never sees half a file
+    pq.write_table(table, SNAPSHOT_PATH + ".tmp")
+    os.replace(SNAPSHOT_PATH + ".tmp", SNAPSHOT_PATH)
+
+@st.cache_data(ttl=VERSION_TTL)
+def current_version():
+    # One probe every VERSION_TTL seconds for all sessions; while the
+    # classifier is writing, results are at most that much behind
+    with read_pool().connection() as conn:
+        return get_data_version(conn)
+
+@st.cache_data(max_entries=1)
+def load_rollup(version):
+    """
+    Message counts per (day, type, user) from the daily_counts rollup,
+    which ingestion and classification keep up to date.
+
+    The frame is kept as a Parquet snapshot (categorical user/type) next to
+    the DB and memory-mapped on load. It is rebuilt only when `version`
+    (see db.get_data_version) moves: if messages were only appended, just
+    the days they fall on are re-read; any other change rebuilds it whole.
+    """
+    snapshot = read_snapshot_version()
+    if snapshot == version:
+        return pd.read_parquet(SNAPSHOT_PATH, memory_map=True)
+
+    with read_pool().connection() as conn:
+        if snapshot is not None and snapshot[0] == version[0] and snapshot[1] < version[1]:
+            since = get_first_day_after(conn, snapshot[1])
+            kept = pd.read_parquet(SNAPSHOT_PATH, memory_map=True)
+            kept = kept.loc[kept['day'] < pd.Timestamp(since), ['day', 'type_raw', 'user_ssn', 'count']]
+            rollup = pd.concat([kept.astype({'user_ssn': str}), rollup_frame(get_daily_counts(conn, since))],
+                               ignore_index=True)
+        else:
+            rollup = rollup_frame(get_daily_counts(conn))
+
+    rollup = compact(rollup)
+    write_snapshot(rollup, version)
+    return rollup
+
+# Result cache shared by all sessions: entries are keyed by the DB version
+# and `filter_key`, the filter state as serialized into the URL, so viewers
+# with the same filters share results and a version change (classifier,
+# new messages) never serves stale ones. `_filters` is the same selection
+# as SQL parameters; Streamlit doesn't hash underscore arguments.
+@st.cache_data(max_entries=RESULT_CACHE_ENTRIES)
+def browse_page(version, filter_key, before, _filters):
+    with read_pool().connection() as conn:
+        return browse_messages(conn, before=before, limit=BROWSER_PAGE_SIZE, **_filters)
+
+@st.cache_data(max_entries=RESULT_CACHE_ENTRIES)
+def search_page(version, filter_key, text, page, _filters):
+    with read_pool().connection() as conn:
+        return search_messages(conn, text, limit=SEARCH_PAGE_SIZE,
+                               offset=(page - 1) * SEARCH_PAGE_SIZE, **_filters)
+
+@st.cache_data(max_entries=RESULT_CACHE_ENTRIES)
+def campaign_rows(version, filter_key, _filters):
+    with read_pool().connection() as conn:
+        return get_campaigns(conn, min_reposts=CAMPAIGN_MIN_REPOSTS, limit=CAMPAIGN_LIMIT, **_filters)
+
+def to_frame(rows):
+    """Page of (id, timestamp, user_ssn, type, content) rows -> display frame."""
+    page = pd.DataFrame(rows, columns=['id', 'timestamp', 'user_ssn', 'type_raw', 'content'])
+    page['type'] = type_labels(page['type_raw'].fillna(-1).astype(int))
+    return page[['timestamp', 'user_ssn', 'type', 'content']]
 
 # ---------------------------------------------------------
 # 2. PAGE SETUP
@@ -58,8 +186,10 @@ def load_data():
 st.set_page_config(page_title="Database Inspector", layout="wide")
 st.title("📂 Análise das mensagens do Canal MEDFundão")
 
-df = load_data()
-if df.empty:
+check_schema()
+version = current_version()
+rollup = load_rollup(version)
+if rollup.empty:
     st.warning("No data found.")
     st.stop()
 
@@ -81,14 +211,11 @@ def get_param_date(key, default_date):
     except ValueError: return default_date
 
 # --- CALCULATE DEFAULTS ---
-if not df['timestamp'].isnull().all():
-    min_db_date = df['timestamp'].min().date()
-    max_db_date = df['timestamp'].max().date()
-else:
-    min_db_date = max_db_date = pd.to_datetime("today").date()
+min_db_date = rollup['day'].min().date()
+max_db_date = rollup['day'].max().date()
 
-all_users_list = sorted(df['user_ssn'].unique().tolist())
-all_types_list = sorted(df['type'].unique().tolist())
+all_users_list = sorted(rollup['user_ssn'].cat.categories.tolist())
+all_types_list = sorted(rollup['type'].cat.categories.tolist())
 
 # --- RESTORE STATE FROM URL ---
 if "init" not in st.session_state:
@@ -180,48 +307,91 @@ if not all_types_check:
 
 st.query_params.clear() # Optional: Clear old junk keys
 st.query_params.update(current_params)
+# Hashable form of the URL state, the key of the shared result cache
+filter_key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in current_params.items()))
 
 # ---------------------------------------------------------
 # 6. DASHBOARD
 # ---------------------------------------------------------
-mask = (
-    (df['timestamp'].dt.date >= start_date) & 
-    (df['timestamp'].dt.date <= end_date) & 
-    (df['user_ssn'].isin(selected_users)) & 
-    (df['type'].isin(selected_types))
+rollup_mask = (
+    (rollup['day'] >= pd.Timestamp(start_date)) &
+    (rollup['day'] <= pd.Timestamp(end_date)) &
+    select_codes(rollup['user_ssn'], selected_users) &
+    select_codes(rollup['type'], selected_types)
 )
-filtered_df = df.loc[mask]
+filtered_rollup = rollup.loc[rollup_mask]
+
+# Same selection as SQL parameters for the browser and search; None = "all"
+type_codes = rollup.drop_duplicates('type').set_index('type')['type_raw'].astype(int)
+filters = {
+    "start": start_date if enable_date else None,
+    "end": end_date if enable_date else None,
+    "users": None if all_users_check else selected_users,
+    "types": None if all_types_check else type_codes.reindex(selected_types).dropna().tolist(),
+}
 
 col1, col2, col3 = st.columns(3)
-col1.metric("Total Messages", len(filtered_df))
-col2.metric("Unique Users", filtered_df['user_ssn'].nunique())
-col3.metric("Msg Types Found", filtered_df['type'].nunique())
+col1.metric("Total Messages", int(filtered_rollup['count'].sum()))
+col2.metric("Unique Users", filtered_rollup['user_ssn'].nunique())
+col3.metric("Msg Types Found", filtered_rollup['type'].nunique())
 
 st.markdown("---")
 
-tab1, tab2, tab3 = st.tabs(["📊 Analytics", "📄 Message Browser", "🔎 Search"])
+tab1, tab2, tab3, tab4 = st.tabs(["📊 Analytics", "📄 Message Browser", "🔎 Search", "📣 Campaigns"])
 
 with tab1:
     c1, c2 = st.columns(2)
-    if not filtered_df.empty:
-        fig_t = px.pie(filtered_df['type'].value_counts().reset_index(), values='count', names='type', hole=0.4, title="Distribution by Type")
+    if not filtered_rollup.empty:
+        type_counts = filtered_rollup.groupby('type', as_index=False, observed=True)['count'].sum()
+        fig_t = px.pie(type_counts, values='count', names='type', hole=0.4, title="Distribution by Type")
         c1.plotly_chart(fig_t)
         
-        user_counts = filtered_df['user_ssn'].value_counts().reset_index().head(10)
+        user_counts = filtered_rollup.groupby('user_ssn', as_index=False, observed=True)['count'].sum().nlargest(10, 'count')
         fig_u = px.bar(user_counts, x='user_ssn', y='count', color='count', title="Top Users")
         c2.plotly_chart(fig_u)
         
-        timeline = filtered_df.groupby(filtered_df['timestamp'].dt.date).size().reset_index(name='count')
+        timeline = filtered_rollup.groupby('day', as_index=False)['count'].sum().rename(columns={'day': 'timestamp'})
         fig_time = px.line(timeline, x='timestamp', y='count', markers=True, title="Activity Timeline")
         st.plotly_chart(fig_time)
 
 with tab2:
-    st.dataframe(filtered_df[['timestamp', 'user_ssn', 'type', 'content']], width="stretch", hide_index=True)
+    # Stack of page cursors, restarted whenever the filters change
+    if st.session_state.get("browser_filters") != filters:
+        st.session_state["browser_filters"] = filters
+        st.session_state["browser_cursors"] = [None]
+    cursors = st.session_state["browser_cursors"]
+
+    rows = browse_page(version, filter_key, cursors[-1], filters)
+
+    prev_col, page_col, next_col = st.columns([1, 4, 1])
+    if prev_col.button("⬅️ Newer", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    page_col.caption(f"Page {len(cursors)} ({BROWSER_PAGE_SIZE} messages per page)")
+    if next_col.button("Older ➡️", disabled=len(rows) < BROWSER_PAGE_SIZE):
+        cursors.append((rows[-1][1], rows[-1][0]))
+        st.rerun()
+
+    st.dataframe(to_frame(rows), width="stretch", hide_index=True)
 
 with tab3:
     search = st.text_input("Search Content")
     if search:
-        res = filtered_df[filtered_df['content'].str.contains(search, case=False, na=False)]
-        st.write(f"Found {len(res)} matches")
-        for i, row in res.iterrows():
-            st.text(f"{row['timestamp']} | {row['type']} | {row['user_ssn']}: {row['content']}")
\ No newline at end of file
+        page = st.number_input("Page", min_value=1, value=1, step=1, key="search_page")
+        total, rows = search_page(version, filter_key, search, page, filters)
+        st.write(f"Found {total} matches")
+        if rows:
+            st.dataframe(to_frame(rows), width="stretch", hide_index=True)
+
+with tab4:
+    # Clusters of near-identical messages (near_dup.py): reposted ads and flyers
+    rows = campaign_rows(version, filter_key, filters)
+    st.caption(f"Messages posted at least {CAMPAIGN_MIN_REPOSTS} times, allowing small edits (price, emoji, phone)")
+    if rows:
+        campaigns = pd.DataFrame(rows, columns=['cluster_id', 'reposts', 'users', 'first_seen',
+                                                'last_seen', 'type_raw', 'content'])
+        campaigns['type'] = type_labels(campaigns['type_raw'].fillna(-1).astype(int))
+        st.dataframe(campaigns[['reposts', 'users', 'first_seen', 'last_seen', 'type', 'content']],
+                     width="stretch", hide_index=True)
+    else:
+        st.write("No campaigns found.")
@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+from dotenv import load_dotenv
+
+# Sender names -> "Pessoa N" before they reach the DB (pipeline.py's
+# anonymize stage, split.py --anonymize). user_aliases maps a keyed hash of each name to its alias,
+# so the same sender keeps it across runs and the name is never written.
+#
+# The key is ALIAS_KEY (environment or .env) and must never be stored or
+# shipped with the DB: with the key, the hashes give the phone numbers back
+# by brute force in minutes.
+
+ALIAS_PREFIX = "Pessoa "
+ALIAS_GLOB = ALIAS_PREFIX + "[0-9]*"
+ALIAS_KEY_HELP = ("Set ALIAS_KEY in the environment or .env (never next to the database) to a secret of"
+                  " 32 to 128 hex digits, e.g. from: python -c \"import secrets; print(secrets.token_hex(32))\"."
+                  " Keep it: the same key gives the same senders the same aliases on later runs.")
+
+LAST_ALIAS_SQL = f"""
+    SELECT COALESCE(MAX(CAST(substr(ssn, {len(ALIAS_PREFIX) + 1}) AS INTEGER)), 0)
+    FROM users WHERE ssn GLOB '{ALIAS_GLOB}'
+"""
+ALIAS_INSERT_SQL = "INSERT OR IGNORE INTO user_aliases (name_hash, alias) VALUES (?, ?)"
+# Senders of a chat (2nd parameter) a run can't store under the same name
+# again: aliases when keeping names (1st parameter), else every name without
+# a stored hash (real names, renamed by maintenance.py anonymize, or hashed
+# with a dropped key)
+ORPHAN_SENDERS_SQL = f"""
+    SELECT COUNT(*) FROM users u
+    WHERE CASE WHEN ? THEN u.ssn GLOB '{ALIAS_GLOB}'
+               ELSE NOT EXISTS (SELECT 1 FROM user_aliases a WHERE a.alias = u.ssn) END
+      AND EXISTS (SELECT 1 FROM messages m WHERE m.user_id = u.id AND m.source = ?)
+"""
+
+
+def alias_key():
+    """The user_aliases key from ALIAS_KEY (hex); exits with instructions if it is missing or malformed."""
+    load_dotenv()
+    try:
+        key = bytes.fromhex(os.getenv("ALIAS_KEY", ""))
+    except ValueError:
+        key = b""
+    if not 16 <= len(key) <= 64:  # blake2b keys are at most 64 bytes
+        raise SystemExit(f"ALIAS_KEY is missing or not 16-64 bytes of hex. {ALIAS_KEY_HELP}")
+    return key
+
+
+class Anonymizer:
+    """
+    Sender name -> "Pessoa N", numbered in order of first appearance after
+    the highest alias already in the DB. The same name always gets the same
+    alias: user_aliases maps a keyed hash of it to the alias. The key never
+    touches the DB; only a check value of it does (meta.alias_key_check), so
+    a run with another key is refused instead of silently re-aliasing everyone.
+    """
+
+    def __init__(self, conn, key):
+        c = conn.cursor()
+        check = int.from_bytes(hashlib.blake2b(b"alias key check", digest_size=7, key=key).digest(), "little")
+        row = c.execute("SELECT value FROM meta WHERE key = 'alias_key_check'").fetchone()
+        if row is None:
+            c.execute("INSERT INTO meta (key, value) VALUES ('alias_key_check', ?)", (check,))
+            conn.commit()
+        elif row[0] != check:
+            raise SystemExit(f"ALIAS_KEY is not the key this database's aliases were made with. {ALIAS_KEY_HELP}")
+        self.key = key
+        self.aliases = dict(c.execute("SELECT name_hash, alias FROM user_aliases"))
+        self.next_number = c.execute(LAST_ALIAS_SQL).fetchone()[0] + 1
+        self.new = []
+
+    def alias(self, name):
+        name_hash = hashlib.blake2b(name.encode("utf-8"), digest_size=16, key=self.key).hexdigest()
+        alias = self.aliases.get(name_hash)
+        if alias is None:
+            alias = self.aliases[name_hash] = f"{ALIAS_PREFIX}{self.next_number}"
+            self.next_number += 1
+            self.new.append((name_hash, alias))
+        return alias
+
+    def take_new(self):
+        """(name_hash, alias) pairs created since the last call, to be stored with their rows."""
+        new, self.new = self.new, []
+        return new
+
+
+def orphan_senders(conn, chat, keep_names):
+    """How many senders of `chat` a re-read would store under another name (see ORPHAN_SENDERS_SQL)."""
+    return conn.execute(ORPHAN_SENDERS_SQL, (keep_names, chat)).fetchone()[0]
+
@@ -1,24 +1,58 @@
+import argparse
+import asyncio
+import itertools
 import json
-import threading
+import os
+import random
+import re
+import time
+import unicodedata
+from collections import defaultdict
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai import OpenAI
+from openai import (AsyncOpenAI, APIConnectionError, APIStatusError,
+                    AuthenticationError, PermissionDeniedError, NotFoundError)
 from dotenv import load_dotenv
-import os
 
 # Importing your DB functions
-# Ensure setup_database returns a fresh sqlite3 connection object
-from db import setup_database, get_untagged_messages, update_message_type
+from db import (
+    setup_database, database_path, iter_untagged_messages, count_untagged_messages, content_hash, ResultWriter,
+    CACHE_LOOKUP_SQL, CACHE_INSERT_SQL,
+)
+from prefilter import Prefilter
+import metrics
+import near_dup
 
 load_dotenv()
 # --- CONFIGURATION ---
 API_KEY = os.getenv("API_KEY")
-BASE_URL = "https://api.deepseek.com"
-MAX_WORKERS = 10       # Number of simultaneous threads (Don't set too high to avoid API rate limits)
-BATCH_SIZE = 25       # Messages per API call
-TOTAL_FETCH_LIMIT = 273 # How many messages to fetch from DB in the "big get"
-
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+BASE_URL = os.getenv("BASE_URL", "https://api.deepseek.com")  # point at fake_llm_server.py for tests
+MODEL = "deepseek-chat"
+CONCURRENCY = int(os.getenv("CONCURRENCY", 200))      # In-flight API calls
+QUEUE_SIZE = CONCURRENCY * 2                          # Batches waiting for a worker (backpressure)
+REQUESTS_PER_MINUTE = int(os.getenv("REQUESTS_PER_MINUTE", 1000))
+TOKENS_PER_MINUTE = int(os.getenv("TOKENS_PER_MINUTE", 1_000_000))
+TOKEN_BUDGET = int(os.getenv("TOKEN_BUDGET", 2000))  # Estimated tokens of messages packed per API call
+MAX_BATCH_MESSAGES = 100  # Upper bound per call, however short the messages are
+MAX_TEXT_CHARS = 1000 # Messages are truncated to this before being sent (and cached)
+ITEM_OVERHEAD_TOKENS = 8       # {"id": ..., "text": ...} wrapping of each message
+OUTPUT_TOKENS_PER_MESSAGE = 12 # {"id": ..., "codigo": "06"} in the answer
+MAX_RETRIES = 4       # Attempts per batch before it is split in half
+BACKOFF_BASE = 1.0    # Seconds; doubled on every retry, with full jitter
+BACKOFF_MAX = 60.0
+VALID_TYPES = set(range(1, 12))
+PAGE_SIZE = 1000      # Untagged rows read from the DB per query
+PROGRESS_INTERVAL = 5 # Seconds between progress lines
+
+API_SECONDS = metrics.histogram("llm_request_seconds", "Chat completion latency, by outcome")
+API_REQUESTS = metrics.counter("llm_requests_total", "Chat completion calls, by HTTP status (or error type)")
+API_TOKENS = metrics.counter("llm_tokens_total", "Tokens reported by the API: prompt, cached (part of prompt), completion")
+RATE_LIMIT_WAIT = metrics.histogram("llm_rate_limiter_wait_seconds", "Time a call waited for the local rate limiter")
+RETRIES = metrics.counter("llm_retries_total", "Batches sent again after a failed attempt")
+SPLITS = metrics.counter("llm_batch_splits_total", "Failing batches split in half")
+DEAD_LETTERS = metrics.counter("llm_dead_letters_total", "Messages given up on")
+LABELS = metrics.counter("classifier_labels_total", "Messages labeled, by where the label came from")
+QUEUE_DEPTH = metrics.gauge("classifier_queue_depth", "Batches waiting for a worker")
+IN_FLIGHT = metrics.gauge("classifier_batches_in_flight", "Batches being classified by a worker")
 
 SYSTEM_PROMPT = """Você é um classificador especializado em grupos de Whatsapp de Medicina. 
 Sua tarefa é CLASSIFICAR mensagens em categorias numeradas.
@@ -88,107 +122,619 @@ Exemplo de saída: [{"id": 1, "codigo": "09"}, {"id": 2, "codigo": "03"}]
 NÃO RESPONDA COM O TEXTO DA MENSAGEM, APENAS O JSON COM O CÓDIGO DE CLASSIFICAÇÃO!
 """
 
-def classify_batch(messages_batch):
+class TokenBucket:
     """
-    Sends the batch to the LLM.
-    Added try/except to prevent one API failure from crashing the whole script.
+    Classic token bucket: holds up to `capacity` tokens and refills at
+    `rate` tokens per second. acquire() waits until enough tokens are available.
     """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)  # an oversized request must still pass eventually
+        # The lock keeps waiters FIFO so large requests are not starved by small ones
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount):
+        """Gives back (positive) or charges (negative) tokens after the fact."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Global requests/min + tokens/min limit shared by every worker."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+
+    async def acquire(self, estimated_tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Corrects the token bucket once the real usage is known."""
+        self.tokens.adjust(estimated_tokens - actual_tokens)
+
+
+def build_messages(messages_batch):
+    # The system prompt must stay byte-for-byte identical and come first:
+    # it is the shared prefix the provider's prompt cache matches on.
     user_content = f"Classifique:\n{json.dumps(messages_batch, ensure_ascii=False)}"
-    
-    messages = [
+    return [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": user_content}
     ]
 
+
+TOKEN_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """
+    Local token estimate, no tokenizer download needed: BPE vocabularies
+    split words into ~4 character pieces, and punctuation/emoji cost about
+    one token each. Good enough for packing and rate limiting.
+    """
+    return sum((len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == "_" else 1
+               for piece in TOKEN_PIECE.findall(text))
+
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+
+
+def estimate_request_tokens(messages_batch):
+    """Prompt + expected answer, charged to the rate limiter before the call."""
+    return (SYSTEM_PROMPT_TOKENS
+            + sum(item["tokens"] for item in messages_batch)
+            + OUTPUT_TOKENS_PER_MESSAGE * len(messages_batch))
+
+
+def make_item(message_id, content):
+    """Truncates a message to what fits in one request and tags it with its token estimate."""
+    text = content[:MAX_TEXT_CHARS]
+    tokens = estimate_tokens(text)
+    while tokens + ITEM_OVERHEAD_TOKENS > TOKEN_BUDGET and len(text) > 1:
+        text = text[:len(text) * 3 // 4]
+        tokens = estimate_tokens(text)
+    return {"id": message_id, "text": text, "tokens": tokens + ITEM_OVERHEAD_TOKENS}
+
+
+def pack_batches(items, token_budget=TOKEN_BUDGET, max_messages=MAX_BATCH_MESSAGES):
+    """
+    Greedily fills each batch up to `token_budget` estimated tokens, so a
+    request carries many short "kkkk" messages or a few long ads, and the
+    system prompt overhead is paid once per full request.
+    """
+    batch, used = [], 0
+    for item in items:
+        if batch and (used + item["tokens"] > token_budget or len(batch) >= max_messages):
+            yield batch
+            batch, used = [], 0
+        batch.append(item)
+        used += item["tokens"]
+    if batch:
+        yield batch
+
+
+class TokenUsage:
+    """Token accounting per classified message, to tune TOKEN_BUDGET against cost and latency."""
+
+    def __init__(self):
+        self.requests = 0
+        self.messages = 0
+        self.prompt = 0
+        self.cached = 0
+        self.completion = 0
+
+    def add(self, usage, messages):
+        self.requests += 1
+        self.messages += messages
+        self.prompt += usage.prompt_tokens or 0
+        self.completion += usage.completion_tokens or 0
+        # DeepSeek reports prompt_cache_hit_tokens, OpenAI prompt_tokens_details.cached_tokens
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cached is None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None)
+        self.cached += cached or 0
+        API_TOKENS.inc(usage.prompt_tokens or 0, kind="prompt")
+        API_TOKENS.inc(cached or 0, kind="cached")
+        API_TOKENS.inc(usage.completion_tokens or 0, kind="completion")
+
+    def report(self):
+        if self.messages:
+            cached_share = self.cached / self.prompt if self.prompt else 0
+            print(f"Tokens: {self.prompt / self.messages:.1f} in ({cached_share:.0%} from prompt cache)"
+                  f" + {self.completion / self.messages:.1f} out per message"
+                  f" | {self.messages / self.requests:.1f} messages per request")
+
+
+async def request_labels(client, limiter, messages_batch, usage=None):
+    """
+    One API call for the batch, once the rate limiter allows it.
+    Returns the parsed JSON answer; raises on API or parsing errors.
+    """
+    messages = build_messages([{"id": item["id"], "text": item["text"]} for item in messages_batch])
+    estimated = estimate_request_tokens(messages_batch)
+    with RATE_LIMIT_WAIT.time():
+        await limiter.acquire(estimated)
+
+    start = time.perf_counter()
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
+        response = await client.chat.completions.create(
+            model=MODEL,
             messages=messages,
             stream=False,
             temperature=0.1 # Lower temp for more consistent formatting
         )
-        content = response.choices[0].message.content
-        # Remove markdown code blocks if the AI adds them (common issue)
-        clean_content = content.replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_content)
     except Exception as e:
-        print(f"Error in API call: {e}")
-        return []
+        API_SECONDS.observe(time.perf_counter() - start, outcome="error")
+        API_REQUESTS.inc(status=str(getattr(e, "status_code", None) or type(e).__name__))
+        raise
+    API_SECONDS.observe(time.perf_counter() - start, outcome="ok")
+    API_REQUESTS.inc(status="200")
+    if response.usage is not None:
+        limiter.settle(estimated, response.usage.total_tokens)
+        if usage is not None:
+            usage.add(response.usage, len(messages_batch))
+    content = response.choices[0].message.content
+    # Remove markdown code blocks if the AI adds them (common issue)
+    clean_content = content.replace("```json", "").replace("```", "").strip()
+    results = json.loads(clean_content)
+    if not isinstance(results, list):
+        raise ValueError(f"expected a JSON list, got {type(results).__name__}")
+    return results
+
+
+def reconcile(messages_batch, results):
+    """
+    Keeps only answers for ids that were actually sent, with a valid code.
+    Returns {message_id: type}; ids missing from it were not classified.
+    """
+    sent = {item["id"] for item in messages_batch}
+    labels = {}
+    for result in results:
+        try:
+            # Ensure we handle cases where AI might miss a field
+            message_id, new_type = int(result["id"]), int(result["codigo"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if message_id in sent and new_type in VALID_TYPES:
+            labels[message_id] = new_type
+    return labels
+
+
+def is_retryable(error):
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    # Connection problems, timeouts and malformed model output are usually transient
+    return isinstance(error, (APIConnectionError, ValueError))
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+async def classify_batch(client, limiter, messages_batch, usage=None, progress=None):
+    """
+    Calls the API with up to MAX_RETRIES attempts. Returns (labels, error):
+    the reconciled {message_id: type} and the last error if every attempt failed.
+    Bad credentials or model names are re-raised: retrying or dead-lettering
+    would only burn through the backlog.
+    """
+    error = None
+    for attempt in range(MAX_RETRIES):
+        if attempt:
+            if progress is not None:
+                progress.retries += 1
+            RETRIES.inc()
+            await asyncio.sleep(backoff_delay(attempt))
+        try:
+            results = await request_labels(client, limiter, messages_batch, usage)
+            return reconcile(messages_batch, results), None
+        except (AuthenticationError, PermissionDeniedError, NotFoundError):
+            raise
+        except Exception as e:
+            error = e
+            if not is_retryable(e):
+                break
+    return {}, error
+
+
+async def classify_robust(client, limiter, messages_batch, usage=None, progress=None):
+    """
+    Classifies the batch, recovering from partial and failed answers:
+    - ids the model left out are re-sent on their own
+    - a batch that keeps failing is split in half and each half retried,
+      which isolates the message that breaks it
+    - a single message that still fails is given up on
+    Returns (labels, dead) where dead is a list of (item, error message).
+    """
+    labels, error = await classify_batch(client, limiter, messages_batch, usage, progress)
+    missing = [item for item in messages_batch if item["id"] not in labels]
+    if not missing:
+        return labels, []
+
+    if labels:
+        # Partial answer: only the ids it skipped go around again
+        more_labels, dead = await classify_robust(client, limiter, missing, usage, progress)
+        labels.update(more_labels)
+        return labels, dead
+
+    reason = f"{type(error).__name__}: {error}" if error else "model answered without usable labels"
+    if len(messages_batch) == 1:
+        return {}, [(messages_batch[0], reason)]
+
+    if progress is not None:
+        progress.splits += 1
+    SPLITS.inc()
+    half = len(messages_batch) // 2
+    (left, left_dead), (right, right_dead) = await asyncio.gather(
+        classify_robust(client, limiter, messages_batch[:half], usage, progress),
+        classify_robust(client, limiter, messages_batch[half:], usage, progress),
+    )
+    return {**left, **right}, left_dead + right_dead
+
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """
+    Canonical form used as the cache key: the same truncation the classifier
+    applies, case-folded, without emoji/symbols and with collapsed whitespace,
+    so reposts of the same flyer with different emoji or spacing collide.
+    """
+    text = unicodedata.normalize("NFKC", text[:MAX_TEXT_CHARS]).casefold()
+    # So = emoji & pictographs, Sk = skin-tone modifiers, Mn/Cf = variation selectors & ZWJ
+    text = "".join(ch for ch in text if unicodedata.category(ch) not in ("So", "Sk", "Mn", "Cf"))
+    return WHITESPACE.sub(" ", text).strip()
+
+
+def cache_key(text):
+    return content_hash(normalize_text(text))
 
-def process_batch_worker(batch_data):
+
+class ClassificationCache:
+    """
+    Persistent label cache keyed by the normalized content hash, plus
+    in-run de-duplication: while a text is waiting for the API, later copies
+    are parked behind it and receive the same label when it comes back.
+    Near-duplicates (same near_dup cluster) are treated like copies, unless
+    `near_dups` is off.
+    """
+
+    def __init__(self, conn, writer, near_dups=True):
+        self.conn = conn
+        self.writer = writer
+        self.near_dups = near_dups
+        self.in_flight = {}       # cache key -> ids waiting for the same answer
+        self.batch_keys = {}      # id sent to the API -> its cache key
+        self.cluster_keys = {}    # near-dup cluster -> cache key of the member sent
+        self.key_clusters = {}    # and back, to learn the cluster's label
+        self.cluster_labels = {}  # near-dup cluster -> label answered in this run
+        self.hits = 0             # labeled from the persistent cache
+        self.duplicates = 0       # labeled from a copy sent earlier in this run
+        self.near_hits = 0        # labeled from a near-duplicate (earlier or in this run)
+        self.sent = 0             # actually sent to the API
+
+    def lookup(self, keys):
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        c = self.conn.cursor()
+        c.execute(CACHE_LOOKUP_SQL.format(placeholders=placeholders), list(keys))
+        return dict(c.fetchall())
+
+    def split(self, rows, prefilter=None):
+        """
+        Splits a page of (id, content) rows into messages labeled without the
+        API, returned as {label_source: [(id, type), ...]}, and the items that
+        still need it.
+        """
+        keyed = [(message_id, content, cache_key(content)) for message_id, content in rows]
+        known = self.lookup({key for _, _, key in keyed})
+        clusters, cluster_labels = self.lookup_clusters(
+            [message_id for message_id, _, key in keyed if key not in known])
+
+        labeled, misses = defaultdict(list), []
+        for message_id, content, key in keyed:
+            cluster = clusters.get(message_id)
+            if key in known:
+                labeled["cache"].append((message_id, known[key]))
+                self.hits += 1
+            elif key in self.in_flight:
+                self.in_flight[key].append(message_id)
+                self.duplicates += 1
+                LABELS.inc(source="duplicate")
+            elif cluster in cluster_labels:
+                labeled["near_dup"].append((message_id, cluster_labels[cluster]))
+                self.near_hits += 1
+            elif self.cluster_keys.get(cluster) in self.in_flight:
+                self.in_flight[self.cluster_keys[cluster]].append(message_id)
+                self.near_hits += 1
+                LABELS.inc(source="near_dup")
+            else:
+                local = prefilter.classify(content) if prefilter else None
+                if local is not None:
+                    msg_type, source = local
+                    labeled[source].append((message_id, msg_type))
+                    continue
+                self.in_flight[key] = [message_id]
+                self.batch_keys[message_id] = key
+                if cluster is not None:
+                    self.cluster_keys[cluster] = key
+                    self.key_clusters[key] = cluster
+                misses.append(make_item(message_id, content))
+                self.sent += 1
+        return labeled, misses
+
+    def lookup_clusters(self, message_ids):
+        """
+        ({message_id: near-dup cluster}, {cluster: label}) for a page: the
+        label is the one answered in this run, else the most common one
+        among the cluster's labeled messages.
+        """
+        if not self.near_dups or not message_ids:
+            return {}, {}
+        clusters = near_dup.get_clusters(self.conn, message_ids)
+        unseen = set(clusters.values()) - self.cluster_labels.keys()
+        labels = near_dup.get_cluster_labels(self.conn, unseen) if unseen else {}
+        labels.update(self.cluster_labels)
+        return clusters, labels
+
+    def resolve(self, labels):
+        """
+        Expands the API answers ({id: type}) to every parked copy and stores
+        them in the cache. Returns (message_id, type) pairs to write.
+        """
+        expanded, cache_rows = [], []
+        for message_id, new_type in labels.items():
+            key = self.batch_keys.pop(message_id, None)
+            if key is None:
+                continue  # id we never sent
+            expanded.extend((waiting_id, new_type) for waiting_id in self.in_flight.pop(key, ()))
+            cache_rows.append((key, new_type))
+            cluster = self.key_clusters.pop(key, None)
+            if cluster is not None:
+                self.cluster_labels[cluster] = new_type
+
+        self.writer.execute_many(CACHE_INSERT_SQL, cache_rows)
+        return expanded
+
+    def fail(self, dead):
+        """
+        Releases texts the API gave up on. Returns (message_id, error) for
+        the message sent and every parked copy, since copies would fail too.
+        """
+        failed = []
+        for item, error in dead:
+            key = self.batch_keys.pop(item["id"], None)
+            self.key_clusters.pop(key, None)
+            failed.extend((waiting_id, error) for waiting_id in self.in_flight.pop(key, [item["id"]]))
+        return failed
+
+    def report(self):
+        total = self.hits + self.duplicates + self.near_hits + self.sent
+        if total:
+            saved = self.hits + self.duplicates + self.near_hits
+            print(f"Cache: {self.hits} hits, {self.duplicates} in-run duplicates, {self.near_hits} near-duplicates,"
+                  f" {self.sent} sent to the API | hit rate {saved / total:.1%}")
+
+
+class Progress:
+    """Live counters for the progress line: throughput, batches in flight, ETA."""
+
+    def __init__(self, total):
+        self.total = total
+        self.classified = 0
+        self.in_flight = 0
+        self.retries = 0
+        self.splits = 0
+        self.dead = 0
+        self.started = time.monotonic()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.classified / elapsed if elapsed > 0 else 0
+        remaining = max(self.total - self.classified, 0)
+        eta = f"{remaining / rate / 60:.1f} min" if rate > 0 else "?"
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {self.classified}/{self.total} classified"
+              f" | {rate:.1f} msgs/s | {self.in_flight} batches in flight | ETA {eta}"
+              f" | {self.retries} retries, {self.splits} splits, {self.dead} dead-lettered")
+
+
+async def report_progress(progress, queue):
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        progress.report()
+        QUEUE_DEPTH.set(queue.qsize())
+        IN_FLIGHT.set(progress.in_flight)
+        metrics.flush()
+
+
+async def worker(queue, client, limiter, writer, cache, progress, usage):
+    """Pulls batches off the queue until it receives the None sentinel."""
+    while True:
+        batch = await queue.get()
+        try:
+            if batch is None:
+                return
+            progress.in_flight += 1
+            labels, dead = await classify_robust(client, limiter, batch, usage, progress)
+            updates = cache.resolve(labels)
+            writer.update_types(updates, source="llm")
+            progress.classified += len(updates)
+            LABELS.inc(len(labels), source="llm")
+            if dead:
+                failed = cache.fail(dead)
+                writer.dead_letter(failed)
+                progress.dead += len(failed)
+                DEAD_LETTERS.inc(len(failed))
+        finally:
+            if batch is not None:
+                progress.in_flight -= 1
+            queue.task_done()
+
+
+def iter_batches(conn, cache, writer, progress, prefilter=None, limit=None, retry_dead_letters=False):
     """
-    This function runs inside a thread.
-    1. Calls API
-    2. Opens its OWN database connection (Crucial for SQLite)
-    3. Updates records
+    Streams untagged rows from the DB page by page. Cache hits and messages
+    the local prefilter is confident about are written straight away; the
+    rest is packed into token-budgeted batches for the API.
     """
-    if not batch_data:
-        return
+    rows = iter_untagged_messages(conn, page_size=PAGE_SIZE, include_dead_letters=retry_dead_letters)
+    if limit:
+        rows = itertools.islice(rows, limit)
 
-    # 1. Network Operation (Slow - Good for threading)
-    print(f"[Thread-{threading.get_ident()}] Classifying {len(batch_data)} messages...")
-    results = classify_batch(batch_data)
+    def misses():
+        while True:
+            page = list(itertools.islice(rows, PAGE_SIZE))
+            if not page:
+                return
+            yield from label_page(page, cache, writer, progress, prefilter)
 
-    if not results:
-        return
+    return pack_batches(misses())
 
-    # 2. Database Operation (Fast - Must have own connection)
-    # We open a new connection per thread because SQLite objects are not thread-safe.
+
+def label_page(page, cache, writer, progress, prefilter=None):
+    """
+    Writes the labels the cache, near-duplicates and prefilter give for a
+    page of (id, content) rows; returns the items left for the API.
+    """
+    labeled, to_send = cache.split(page, prefilter)
+    for source, updates in labeled.items():
+        writer.update_types(updates, source=source)
+        progress.classified += len(updates)
+        LABELS.inc(len(updates), source=source)
+    return to_send
+
+
+async def produce(batches, queue, workers):
+    """Feeds the batches to the queue, then one None sentinel per worker."""
+    if hasattr(batches, "__aiter__"):
+        # pipeline.py: batches come from rows still being ingested
+        async for batch in batches:
+            await queue.put(batch)
+    else:
+        for batch in batches:
+            await queue.put(batch)
+    for _ in range(workers):
+        await queue.put(None)
+
+
+async def run(batches, writer, cache, progress, usage, concurrency=CONCURRENCY):
+    """
+    Classifies `batches` with `concurrency` workers. The first error of the
+    producer or of a worker (bad credentials, a failed DB write) cancels the
+    rest and is re-raised, instead of leaving the producer blocked on the
+    full queue once every worker is gone.
+    """
+    # Retries are handled by classify_batch, which also splits failing batches
+    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL, max_retries=0)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    # Bounded queue: the producer blocks when workers fall behind, so only
+    # about QUEUE_SIZE batches are ever read ahead from the DB.
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    workers = [
+        asyncio.create_task(worker(queue, client, limiter, writer, cache, progress, usage))
+        for _ in range(concurrency)
+    ]
+    producer = asyncio.create_task(produce(batches, queue, concurrency))
+    reporter = asyncio.create_task(report_progress(progress, queue))
+    tasks = [producer, *workers]
     try:
-        local_conn = setup_database() 
-        for result in results:
-            try:
-                # Ensure we handle cases where AI might miss a field
-                if "id" in result and "codigo" in result:
-                    update_message_type(local_conn, result["id"], int(result["codigo"]))
-            except Exception as row_error:
-                print(f"Error updating row {result.get('id')}: {row_error}")
-        
-        # Commit usually happens in update_message_type or we can force it here
-        local_conn.commit() 
-    except Exception as db_e:
-        print(f"Database error in thread: {db_e}")
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
     finally:
-        local_conn.close()
-        print(f"[Thread-{threading.get_ident()}] exiting")
+        for task in [*tasks, reporter]:
+            task.cancel()
+        await asyncio.gather(*tasks, reporter, return_exceptions=True)
+        await client.close()
 
-def chunk_list(data, chunk_size):
-    """Yield successive chunks from data."""
-    for i in range(0, len(data), chunk_size):
-        yield data[i:i + chunk_size]
+
+def classify_backlog(conn, limit=None, use_prefilter=True, retry_dead_letters=False, use_near_dups=True):
+    """
+    Keeps classifying until no untagged messages are left. Each pass streams
+    the whole backlog once; another pass picks up rows ingested meanwhile,
+    and we stop when a pass makes no progress. Dead-lettered messages are
+    skipped, unless `retry_dead_letters` is set, which makes a single pass
+    over the whole backlog including them.
+    """
+    if use_near_dups:
+        near_dup.index_new(conn)  # rows ingested without going through split.py
+    prefilter = Prefilter.from_db(conn) if use_prefilter else None
+    usage = TokenUsage()
+    while True:
+        total = count_untagged_messages(conn, include_dead_letters=retry_dead_letters)
+        if limit:
+            total = min(total, limit)
+        if total == 0:
+            print("No untagged messages found.")
+            return
+
+        print(f"{total} untagged messages. Classifying with up to {CONCURRENCY} requests in flight...")
+        progress = Progress(total)
+        # Workers never touch SQLite: results go through the single writer thread
+        writer = ResultWriter(database_path(conn))
+        writer.start()
+        cache = ClassificationCache(conn, writer, near_dups=use_near_dups)
+        try:
+            batches = iter_batches(conn, cache, writer, progress, prefilter, limit, retry_dead_letters)
+            asyncio.run(run(batches, writer, cache, progress, usage))
+        finally:
+            writer.close()
+        progress.report()
+        cache.report()
+        usage.report()
+        if prefilter:
+            prefilter.report()
+        print(f"Wrote {writer.written} updates in {writer.transactions} transactions")
+
+        if progress.dead:
+            print(f"{progress.dead} messages moved to dead_letters (see the table for errors)")
+
+        if limit or retry_dead_letters or progress.classified == 0:
+            return
 
 # --- MAIN EXECUTION ---
 if __name__ == "__main__":
-    print(f"Starting Process at {datetime.now().strftime('%H:%M:%S')}")
+    parser = argparse.ArgumentParser(description="Classify untagged messages with the LLM")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="classify at most N messages and stop (default: drain the backlog)")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="send everything the cache can't answer to the LLM")
+    parser.add_argument("--retry-dead-letters", action="store_true",
+                        help="also re-send messages that previously failed")
+    parser.add_argument("--no-near-dups", action="store_true",
+                        help="don't label near-duplicates (near_dup.py clusters) from one answer")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
 
-    # 1. The 'Big Get' - Fetch raw data in the main thread
-    main_conn = setup_database()
-    raw_data = get_untagged_messages(main_conn, limit=TOTAL_FETCH_LIMIT)
-    main_conn.close() # Close immediately so threads don't fight over this connection
-
-    if not raw_data:
-        print("No untagged messages found.")
-        exit()
-
-    print(f"Fetched {len(raw_data)} messages. Splitting into threads...")
-
-    # 2. Format Data
-    # Assuming row is (id, text, ...)
-    formatted_data = [{"id": row[0], "text": row[1][:200]} for row in raw_data]
-
-    # 3. Create Batches
-    batches = list(chunk_list(formatted_data, BATCH_SIZE))
-
-    # 4. Process in Parallel
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all batches to the pool
-        futures = [executor.submit(process_batch_worker, batch) for batch in batches]
-        
-        # Wait for completion (optional, strictly for UI/Progress monitoring)
-        for future in as_completed(futures):
-            try:
-                future.result() # Check for exceptions
-            except Exception as e:
-                print(f"Thread generated an exception: {e}")
-
-    print(f"Finished at {datetime.now().strftime('%H:%M:%S')}")
\ No newline at end of file
+    print(f"Starting Process at {datetime.now().strftime('%H:%M:%S')}")
+    conn = setup_database()
+    with metrics.instrumented(args, "classify"):
+        classify_backlog(conn, args.limit, use_prefilter=not args.no_prefilter,
+                         retry_dead_letters=args.retry_dead_letters, use_near_dups=not args.no_near_dups)
+    conn.close()
+    print(f"Finished at {datetime.now().strftime('%H:%M:%S')}")
@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+from array import array
+from datetime import datetime
+from openai import OpenAI, AsyncOpenAI, APIError
+
+from db import (
+    setup_database, database_path, iter_untagged_messages, get_message_contents, ResultWriter, CACHE_INSERT_SQL,
+)
+from prefilter import Prefilter
+import metrics
+import near_dup
+from async_deepseek_classifier import (
+    API_KEY, BASE_URL, MODEL, CONCURRENCY, PAGE_SIZE, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE,
+    ClassificationCache, Progress, RateLimiter, build_messages,
+    cache_key, estimate_tokens, iter_batches, reconcile,
+)
+
+# Offline mode for large backfills, at batch-API pricing:
+#
+#   python batch_classifier.py export              # untagged messages -> batch_requests.jsonl
+#   python batch_classifier.py submit              # upload + create a provider batch job
+#   python batch_classifier.py fetch <batch_id>    # download its output -> batch_results.jsonl
+#   python batch_classifier.py ingest              # batch_results.jsonl -> messages.type
+#
+# Providers without a batch endpoint can use `run-local` instead of
+# submit/fetch: it replays the request file against BASE_URL and writes the
+# same result format.
+#
+# export also writes the message ids of every request to a small sidecar
+# (batch_requests.ids.jsonl), which ingest reads instead of the request file:
+# only ids are held in memory, never the exported texts.
+
+REQUESTS_FILE = "batch_requests.jsonl"
+RESULTS_FILE = "batch_results.jsonl"
+ENDPOINT = "/v1/chat/completions"
+
+
+def request_line(batch):
+    """One line of the batch input file, in the OpenAI batch format."""
+    return {
+        "custom_id": f"msgs-{batch[0]['id']}-{len(batch)}",
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {
+            "model": MODEL,
+            "messages": build_messages([{"id": item["id"], "text": item["text"]} for item in batch]),
+            "temperature": 0.1,
+        },
+    }
+
+
+def export_requests(conn, path=REQUESTS_FILE, limit=None, use_prefilter=True):
+    """
+    Streams the untagged backlog into a JSONL request file, packed exactly
+    like the online classifier packs its calls. Cache hits and prefilter
+    answers are written to the DB right away and never reach the file;
+    duplicate texts and near-duplicates are exported once (ingest labels
+    the copies).
+    """
+    near_dup.index_new(conn)
+    prefilter = Prefilter.from_db(conn) if use_prefilter else None
+    writer = ResultWriter(database_path(conn))
+    writer.start()
+    cache = ClassificationCache(conn, writer)
+    progress = Progress(0)
+    requests = 0
+    try:
+        with open(path, "w", encoding="utf-8") as out, open(ids_path(path), "w", encoding="utf-8") as ids:
+            for batch in iter_batches(conn, cache, writer, progress, prefilter, limit):
+                request = request_line(batch)
+                out.write(json.dumps(request, ensure_ascii=False) + "\n")
+                ids.write(json.dumps([request["custom_id"], [item["id"] for item in batch]]) + "\n")
+                requests += 1
+    finally:
+        writer.close()
+
+    print(f"Exported {cache.sent} messages in {requests} requests to {path}"
+          f" ({progress.classified} labeled locally)")
+    cache.report()
+
+
+def submit(path=REQUESTS_FILE):
+    """Uploads the request file and creates a provider batch job."""
+    client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+    with open(path, "rb") as file:
+        uploaded = client.files.create(file=file, purpose="batch")
+    batch = client.batches.create(input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window="24h")
+    print(f"Submitted batch {batch.id} (status: {batch.status})")
+    print(f"Run `python batch_classifier.py fetch {batch.id}` once it completes.")
+
+
+def fetch(batch_id, path=RESULTS_FILE):
+    """Downloads the output of a finished provider batch job."""
+    client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        print(f"Batch {batch_id} is {batch.status}; nothing to download yet.")
+        return
+    with client.files.with_streaming_response.content(batch.output_file_id) as response:
+        response.stream_to_file(path)
+    print(f"Saved results of {batch_id} to {path}")
+
+
+async def run_local(input_path=REQUESTS_FILE, output_path=RESULTS_FILE, concurrency=CONCURRENCY):
+    """
+    Local stand-in for a batch endpoint: sends every request of the input
+    file to BASE_URL (rate limited, `concurrency` at a time) and writes one
+    result line per request, in the provider's output format.
+    """
+    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    slots = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def send(request, out):
+        nonlocal done
+        try:
+            body = request["body"]
+            await limiter.acquire(sum(estimate_tokens(m["content"]) for m in body["messages"]))
+            try:
+                response = await client.chat.completions.create(**body)
+                result = {"status_code": 200, "body": response.model_dump()}
+                error = None
+            except APIError as e:
+                result = {"status_code": getattr(e, "status_code", None), "body": None}
+                error = {"message": str(e)}
+            line = {"id": f"local-{request['custom_id']}", "custom_id": request["custom_id"],
+                    "response": result, "error": error}
+            out.write(json.dumps(line, ensure_ascii=False) + "\n")
+            done += 1
+        finally:
+            slots.release()
+
+    with open(input_path, encoding="utf-8") as requests, open(output_path, "w", encoding="utf-8") as out:
+        tasks = set()
+        for line in requests:
+            await slots.acquire()  # only `concurrency` requests are read ahead
+            task = asyncio.create_task(send(json.loads(line), out))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    await client.close()
+    print(f"Wrote {done} results to {output_path}")
+
+
+def ids_path(requests_path):
+    """The id sidecar export writes next to a request file."""
+    root, extension = os.path.splitext(requests_path)
+    return f"{root}.ids{extension}"
+
+
+def load_request_ids(requests_path=REQUESTS_FILE):
+    """{custom_id: array of the message ids sent}, from the sidecar of a request file."""
+    ids = {}
+    with open(ids_path(requests_path), encoding="utf-8") as sidecar:
+        for line in sidecar:
+            custom_id, message_ids = json.loads(line)
+            ids[custom_id] = array("q", message_ids)
+    return ids
+
+
+def parse_result(record):
+    """The model's JSON answer from one result line; raises if the request failed."""
+    if record.get("error"):
+        raise ValueError(record["error"].get("message", "request failed"))
+    body = (record.get("response") or {}).get("body")
+    if not body:
+        raise ValueError(f"status {(record.get('response') or {}).get('status_code')}")
+    content = body["choices"][0]["message"]["content"]
+    clean_content = content.replace("```json", "").replace("```", "").strip()
+    results = json.loads(clean_content)
+    if not isinstance(results, list):
+        raise ValueError(f"expected a JSON list, got {type(results).__name__}")
+    return results
+
+
+def apply_cached_labels(conn, writer):
+    """
+    Labels untagged copies of texts whose answer is now in the cache, and
+    near-duplicates of labeled messages (export leaves both out of the file).
+    """
+    cache = ClassificationCache(conn, writer)
+    rows = iter_untagged_messages(conn, page_size=PAGE_SIZE)
+    labeled = 0
+    while True:
+        page = list(itertools.islice(rows, PAGE_SIZE))
+        if not page:
+            return labeled
+        keys = [cache_key(content) for _, content in page]
+        known = cache.lookup(set(keys))
+        updates = [(message_id, known[key]) for (message_id, _), key in zip(page, keys) if key in known]
+        writer.update_types(updates, source="cache")
+        clusters, cluster_labels = cache.lookup_clusters(
+            [message_id for (message_id, _), key in zip(page, keys) if key not in known])
+        near = [(message_id, cluster_labels[cluster]) for message_id, cluster in clusters.items()
+                if cluster in cluster_labels]
+        writer.update_types(near, source="near_dup")
+        labeled += len(updates) + len(near)
+
+
+def ingest_results(conn, results_path=RESULTS_FILE, requests_path=REQUESTS_FILE):
+    """
+    Streams the result file into messages.type in bulk, reconciling every
+    answer against the ids its request carried (from the export's id
+    sidecar). Failed requests leave their messages untagged for the next
+    export or online run.
+    """
+    ids_by_request = load_request_ids(requests_path)
+    writer = ResultWriter(database_path(conn))
+    writer.start()
+    labeled = failed = 0
+    try:
+        with open(results_path, encoding="utf-8") as results:
+            for line in results:
+                record = json.loads(line)
+                message_ids = ids_by_request.pop(record.get("custom_id"), None)
+                if message_ids is None:
+                    continue  # not from this request file
+                try:
+                    labels = reconcile([{"id": message_id} for message_id in message_ids], parse_result(record))
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    print(f"Request {record.get('custom_id')} failed: {e}")
+                    failed += len(message_ids)
+                    continue
+                writer.update_types(labels.items(), source="llm")
+                # Keyed on the full stored text, like the online classifier (the request has it truncated)
+                contents = get_message_contents(conn, labels)
+                writer.execute_many(CACHE_INSERT_SQL, [
+                    (cache_key(contents[message_id]), new_type) for message_id, new_type in labels.items()
+                    if message_id in contents
+                ])
+                labeled += len(labels)
+                failed += len(message_ids) - len(labels)
+    finally:
+        writer.close()
+
+    missing = sum(len(message_ids) for message_ids in ids_by_request.values())
+    print(f"Ingested {labeled} labels ({failed} failed or skipped, {missing} without a result line)")
+
+    # Copies of exported texts were left out of the file: label them from the cache now
+    writer = ResultWriter(database_path(conn))
+    writer.start()
+    try:
+        copies = apply_cached_labels(conn, writer)
+    finally:
+        writer.close()
+    print(f"Labeled {copies} duplicate and near-duplicate messages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline (batch API) classification")
+    metrics.add_arguments(parser)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="write untagged messages as batch requests")
+    p_export.add_argument("--output", default=REQUESTS_FILE)
+    p_export.add_argument("--limit", type=int, default=None)
+    p_export.add_argument("--no-prefilter", action="store_true")
+
+    p_submit = sub.add_parser("submit", help="upload the request file to the provider's batch API")
+    p_submit.add_argument("--input", default=REQUESTS_FILE)
+
+    p_fetch = sub.add_parser("fetch", help="download the results of a provider batch")
+    p_fetch.add_argument("batch_id")
+    p_fetch.add_argument("--output", default=RESULTS_FILE)
+
+    p_local = sub.add_parser("run-local", help="replay the request file against BASE_URL")
+    p_local.add_argument("--input", default=REQUESTS_FILE)
+    p_local.add_argument("--output", default=RESULTS_FILE)
+
+    p_ingest = sub.add_parser("ingest", help="load a result file into the database")
+    p_ingest.add_argument("--input", default=RESULTS_FILE)
+    p_ingest.add_argument("--requests", default=REQUESTS_FILE, help="request file; its id sidecar is read")
+
+    args = parser.parse_args()
+    print(f"Starting {args.command} at {datetime.now().strftime('%H:%M:%S')}")
+    with metrics.instrumented(args, f"batch-{args.command}"):
+        if args.command == "export":
+            conn = setup_database()
+            export_requests(conn, args.output, args.limit, use_prefilter=not args.no_prefilter)
+            conn.close()
+        elif args.command == "submit":
+            submit(args.input)
+        elif args.command == "fetch":
+            fetch(args.batch_id, args.output)
+        elif args.command == "run-local":
+            asyncio.run(run_local(args.input, args.output))
+        elif args.command == "ingest":
+            conn = setup_database()
+            ingest_results(conn, args.input, args.requests)
+            conn.close()
+    print(f"Finished at {datetime.now().strftime('%H:%M:%S')}")
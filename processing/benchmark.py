@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+
+from db import (
+    setup_database, store_message, normalize_timestamp, count_untagged_messages, message_filters,
+    BulkLoader, SOURCE_SQL, UNTAGGED_PAGE_SQL, COUNT_UNTAGGED_SQL, MESSAGE_CONTENTS_SQL, TRAINING_MESSAGES_SQL,
+    DATA_VERSION_SQL, MAX_MESSAGE_ID_SQL, FIRST_DAY_AFTER_SQL, DAILY_COUNTS_SQL, SEARCH_COUNT_SQL, SEARCH_SQL, BROWSE_SQL,
+    BROWSE_BEFORE, CAMPAIGNS_SQL, CACHE_LOOKUP_SQL, CACHE_INSERT_SQL, USER_ID_SQL, MESSAGE_INSERT_SQL,
+    BULK_FTS_SQL, BULK_DAILY_COUNTS_SQL, UPDATE_TYPE_SQL, DEAD_LETTER_SQL,
+)
+from split import iter_messages
+import near_dup
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_parse(path):
+    """Parses an export end to end without touching the DB and reports MB/s."""
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    rss_before = peak_rss_mb()
+
+    start = time.perf_counter()
+    count = 0
+    for _ in iter_messages(path):
+        count += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"Parsed {count} messages from {size_mb:.1f} MB in {elapsed:.2f}s")
+    print(f"Throughput: {size_mb / elapsed:.1f} MB/s | {count / elapsed:,.0f} msgs/s")
+    print(f"Peak RSS: {peak_rss_mb():.1f} MB (before parsing: {rss_before:.1f} MB)")
+
+
+def bench_timestamps(path):
+    """strptime + strftime (the old per-row path) vs normalize_timestamp, on the export's own timestamps."""
+    raw = [message.timestamp for message in iter_messages(path)]
+
+    def strptime_path(value):
+        return datetime.strptime(value, "%d/%m/%Y %H:%M").strftime("%Y-%m-%d %H:%M:%S")
+
+    timings = {}
+    for name, convert in (("strptime", strptime_path), ("normalize_timestamp", normalize_timestamp)):
+        normalize_timestamp.cache_clear()
+        start = time.perf_counter()
+        for value in raw:
+            convert(value)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>20}: {len(raw) / timings[name]:>12,.0f} timestamps/s ({timings[name]:.2f}s)")
+
+    info = normalize_timestamp.cache_info()
+    print(f"Distinct timestamps: {len(set(raw))}/{len(raw)} | cache hits: {info.hits}")
+    print(f"Speedup: {timings['strptime'] / timings['normalize_timestamp']:.1f}x")
+
+
+def bench_ingest(path, limit=None):
+    """Loads the same export with store_message and with BulkLoader into scratch DBs."""
+    messages = []
+    for message in iter_messages(path):
+        messages.append(message)
+        if limit and len(messages) >= limit:
+            break
+
+    with tempfile.TemporaryDirectory() as tmp:
+        timings = {}
+        for name in ("store_message", "BulkLoader"):
+            conn = setup_database(os.path.join(tmp, f"{name}.db"))
+            start = time.perf_counter()
+            if name == "store_message":
+                for m in messages:
+                    store_message(conn, m.user, m.timestamp, m.content, m.type)
+            else:
+                with BulkLoader(conn) as loader:
+                    for m in messages:
+                        loader.add(m.user, m.timestamp, m.content, m.type)
+            timings[name] = time.perf_counter() - start
+            conn.close()
+            print(f"{name:>14}: {len(messages) / timings[name]:>12,.0f} msgs/s ({timings[name]:.2f}s)")
+
+    print(f"Speedup: {timings['store_message'] / timings['BulkLoader']:.1f}x")
+
+
+def _filtered(template, before=(), after=(), extra="", **filters):
+    """A {where} template filled with message_filters the way db.py does, and its parameters."""
+    where, params = message_filters(**filters)
+    return template.format(where=where + extra), (*before, *params, *after)
+
+
+NOWHERE = 2 ** 62  # an id past the last message: the catch-up statements find nothing to do
+
+def worker_counts(max_workers):
+    """1, 2, 4, ... up to max_workers, which is always included."""
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    return counts + [max_workers] if max_workers > 1 else counts
+
+
+def bench_scaling(paths, max_workers=os.cpu_count(), chunk_mb=16):
+    """
+    Runs split.ingest on `paths` into a scratch DB with 1..max_workers parser
+    processes and reports the speedup over one worker. "writer idle" is the
+    share of the run the single writer spent waiting for parsed chunks: high
+    means more parsers still help, near 0 means the writer is the bottleneck
+    (with one worker, parsing runs in the writer's process and counts as
+    idle). The near-duplicate index (serial, after the load) is left out.
+    """
+    from split import ingest, PARSER_WAIT
+
+    size_mb = sum(map(os.path.getsize, paths)) / (1024 * 1024)
+    print(f"{os.cpu_count()} CPUs, {size_mb:.1f} MB in {len(paths)} file(s)")
+    print(f"{'workers':>7} {'seconds':>8} {'msgs/s':>10} {'MB/s':>7} {'speedup':>8} {'efficiency':>10} {'writer idle':>11}")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in worker_counts(max_workers):
+            conn = setup_database(os.path.join(tmp, f"scaling_{workers}.db"))
+            waited = PARSER_WAIT.values.get((), 0)
+            start = time.perf_counter()
+            ingest(conn, paths, workers=workers, chunk_size=chunk_mb * 1024 * 1024, index_near_dups=False)
+            elapsed = time.perf_counter() - start
+            idle = (PARSER_WAIT.values.get((), 0) - waited) / elapsed
+            count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            conn.close()
+
+            speedup = results[1]["seconds"] / elapsed if results else 1.0
+            results[workers] = {"seconds": round(elapsed, 3), "messages_per_second": round(count / elapsed),
+                                "speedup": round(speedup, 2), "writer_idle": round(idle, 3)}
+            print(f"{workers:>7} {elapsed:>8.2f} {count / elapsed:>10,.0f} {size_mb / elapsed:>7.1f}"
+                  f" {speedup:>7.2f}x {speedup / workers:>10.0%} {idle:>11.0%}")
+    return results
+
+
+# Every query the project issues, built from the SQL constants db.py and
+# near_dup.py execute, with representative parameters. Writes are rolled back.
+QUERIES = {
+    "db.get_source": (SOURCE_SQL, ("cvs.txt",)),
+    "db.iter_untagged_messages (page)": (UNTAGGED_PAGE_SQL, (False, 0, 1000)),
+    "db.count_untagged_messages": (COUNT_UNTAGGED_SQL, (False,)),
+    "db.get_message_contents": (MESSAGE_CONTENTS_SQL, ("[1, 2, 3]",)),
+    "db.get_training_messages": (TRAINING_MESSAGES_SQL, (200000,)),
+    "db.get_data_version": (DATA_VERSION_SQL, ()),
+    "db.get_data_version (max id)": (MAX_MESSAGE_ID_SQL, ()),
+    "db.get_first_day_after": (FIRST_DAY_AFTER_SQL, (0,)),
+    "db.get_daily_counts": (DAILY_COUNTS_SQL, ("",)),
+    "db.get_daily_counts (since a day)": (DAILY_COUNTS_SQL, ("2024-06-01",)),
+    "db.search_messages (count)": _filtered(SEARCH_COUNT_SQL, before=('"medico"*',)),
+    "db.search_messages": _filtered(SEARCH_SQL, before=('"medico"*',), after=(50, 0)),
+    "db.browse_messages": _filtered(BROWSE_SQL, after=(500,)),
+    "db.browse_messages (next page)": _filtered(BROWSE_SQL, extra=BROWSE_BEFORE, after=("2024-06-01", 0, 500)),
+    "db.browse_messages (type filter)": _filtered(BROWSE_SQL, after=(500,), types=[6]),
+    "db.browse_messages (user filter)": _filtered(BROWSE_SQL, after=(500,), users=["Pessoa 1"]),
+    "db.browse_messages (date range)": _filtered(BROWSE_SQL, after=(500,), start=date(2024, 1, 1),
+                                                 end=date(2024, 1, 31)),
+    "db.get_campaigns": _filtered(CAMPAIGNS_SQL, before=(3,), after=(3, 50)),
+    "classifier cache lookup": (CACHE_LOOKUP_SQL.format(placeholders="?,?,?"), ("a", "b", "c")),
+    "BulkLoader user lookup": (USER_ID_SQL, ("Pessoa 1",)),
+    "BulkLoader message insert": (MESSAGE_INSERT_SQL, (1, "2024-01-01 10:00:00", "benchmark", None,
+                                                       "0000000000000000", None, "cvs", 0)),
+    "BulkLoader FTS catch-up": (BULK_FTS_SQL, (NOWHERE,)),
+    "BulkLoader daily_counts catch-up": (BULK_DAILY_COUNTS_SQL, (NOWHERE,)),
+    "ResultWriter label update": (UPDATE_TYPE_SQL, (6, "llm", 1)),
+    "ResultWriter dead letter": (DEAD_LETTER_SQL, (1, "benchmark")),
+    "ResultWriter cache insert": (CACHE_INSERT_SQL, ("benchmark", 6)),
+    "near_dup index page": (near_dup.INDEX_PAGE_SQL, (0, near_dup.PAGE_SIZE)),
+    "near_dup band lookup": (near_dup.BANDS_SQL, ("[1, 2, 3]",)),
+    "near_dup signature lookup": (near_dup.SIGNATURES_SQL, ("[1, 2, 3]",)),
+    "near_dup.get_clusters": (near_dup.CLUSTERS_SQL, ("[1, 2, 3]",)),
+    "near_dup.get_cluster_labels": (near_dup.CLUSTER_LABELS_SQL, ("[1, 2, 3]",)),
+}
+
+
+# Keyset-paginated queries: their plan must walk this index in order, with
+# no temp B-tree, or every page sorts everything after it
+PLAN_CHECKS = {
+    "db.iter_untagged_messages (page)": "idx_messages_untagged",
+    "db.browse_messages": "idx_messages_timestamp",
+    "db.browse_messages (next page)": "idx_messages_timestamp",
+    "near_dup index page": "INTEGER PRIMARY KEY",
+}
+
+
+def check_plan(name, plan):
+    """Problems with the plan of a PLAN_CHECKS query (empty if it is fine or not checked)."""
+    if name not in PLAN_CHECKS:
+        return []
+    problems = [f"uses {step}" for step in plan if "TEMP B-TREE" in step]
+    if not any(PLAN_CHECKS[name] in step for step in plan):
+        problems.append(f"does not use {PLAN_CHECKS[name]}")
+    return problems
+
+
+def bench_queries(db_path, repeat=5):
+    """
+    Prints EXPLAIN QUERY PLAN and the best-of-N wall time for each query in
+    QUERIES, and checks the plans of PLAN_CHECKS. Returns {name: best
+    milliseconds}; raises SystemExit listing the failed plan checks.
+    """
+    conn = setup_database(db_path)
+    timings = {}
+    failed = []
+    for name, (sql, params) in QUERIES.items():
+        print(f"=== {name}")
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        for step in plan:
+            print(f"    {step}")
+        for problem in check_plan(name, plan):
+            print(f"    PLAN CHECK FAILED: {problem}")
+            failed.append(f"{name} {problem}")
+
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            best = min(best, time.perf_counter() - start)
+        conn.rollback()  # write probes must not persist
+        print(f"    best of {repeat}: {best * 1000:.2f} ms")
+        timings[name] = round(best * 1000, 3)
+    conn.close()
+    if failed:
+        raise SystemExit("Query plan checks failed:\n  " + "\n  ".join(failed))
+    return timings
+
+
+SIZE_SUFFIXES = {"k": 1_000, "M": 1_000_000}
+
+
+def parse_size(text):
+    """'10k' -> 10000, '1M' -> 1000000, '500' -> 500."""
+    multiplier = SIZE_SUFFIXES.get(text[-1], 1)
+    return int(float(text.rstrip("".join(SIZE_SUFFIXES))) * multiplier)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(sizes, workdir, output, baseline=None, workers=os.cpu_count(), classify_limit=200000,
+                llm_latency=0.05, error_rate=0.01, throttle_rate=0.01):
+    """
+    End-to-end run at every size: generate a synthetic export, ingest it,
+    classify up to `classify_limit` messages against a local fake LLM (with
+    injected latency, errors and 429s) and time the dashboard queries.
+    Results are saved as JSON and compared with `baseline` if given.
+    """
+    # Imported here: the classifier pulls in openai/dotenv, which the other
+    # benchmarks don't need
+    import async_deepseek_classifier as classifier
+    import fake_llm_server
+    from split import ingest
+    from synthetic_export import generate
+
+    server = fake_llm_server.serve("127.0.0.1", 0, llm_latency, llm_latency, error_rate, throttle_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    classifier.BASE_URL = f"http://127.0.0.1:{server.server_port}"
+    classifier.API_KEY = "fake"
+    classifier.BACKOFF_BASE = 0.1
+    # Measure the pipeline, not our own quota
+    classifier.REQUESTS_PER_MINUTE = classifier.TOKENS_PER_MINUTE = 10 ** 9
+
+    results = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "cpus": os.cpu_count(),
+        "settings": {"workers": workers, "classify_limit": classify_limit, "llm_latency": llm_latency,
+                     "error_rate": error_rate, "throttle_rate": throttle_rate},
+        "runs": {},
+    }
+    for size in sizes:
+        label = f"{size:,}"
+        run_dir = os.path.join(workdir, str(size))
+        os.makedirs(run_dir, exist_ok=True)
+        export = os.path.join(run_dir, "export.txt")
+        db_path = os.path.join(run_dir, "chat_data.db")
+        for stale in (db_path, db_path + "-wal", db_path + "-shm"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        run = results["runs"][str(size)] = {}
+
+        print(f"##### {label} messages")
+        if not os.path.exists(export):  # the export for a size never changes (fixed seed)
+            generate(export, size)
+        size_mb = os.path.getsize(export) / (1024 * 1024)
+
+        conn = setup_database(db_path)
+        start = time.perf_counter()
+        ingest(conn, [export], workers=workers)
+        elapsed = time.perf_counter() - start
+        run["ingest_seconds"] = round(elapsed, 3)
+        run["ingest_messages_per_second"] = round(size / elapsed)
+        run["ingest_mb_per_second"] = round(size_mb / elapsed, 2)
+        db_files = [path for path in (db_path, db_path + "-wal") if os.path.exists(path)]
+        run["db_mb"] = round(sum(map(os.path.getsize, db_files)) / (1024 * 1024), 1)
+
+        untagged = count_untagged_messages(conn)
+        start = time.perf_counter()
+        classifier.classify_backlog(conn, limit=classify_limit)
+        elapsed = time.perf_counter() - start
+        classified = untagged - count_untagged_messages(conn)
+        run["classify_seconds"] = round(elapsed, 3)
+        run["classified"] = classified
+        run["classify_messages_per_second"] = round(classified / elapsed)
+        conn.close()
+
+        run["query_ms"] = bench_queries(db_path)
+
+    server.shutdown()
+    with open(output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Saved results to {output}")
+
+    if baseline:
+        with open(baseline, encoding="utf-8") as file:
+            compare_results(json.load(file), results)
+
+
+# Metric name -> True if higher is better
+COMPARED_METRICS = {
+    "ingest_messages_per_second": True,
+    "classify_messages_per_second": True,
+}
+
+
+def compare_results(before, after, tolerance=0.10, min_query_ms=0.5):
+    """
+    Prints every metric that got more than `tolerance` worse (or better)
+    than the baseline. Query changes under `min_query_ms` are timer noise.
+    """
+    print(f"=== {before.get('commit')} -> {after.get('commit')}")
+    for size, run in after["runs"].items():
+        old = before["runs"].get(size)
+        if old is None:
+            continue
+        pairs = [(name, higher, old.get(name), run.get(name)) for name, higher in COMPARED_METRICS.items()]
+        pairs += [(f"query: {name}", False, old.get("query_ms", {}).get(name), ms)
+                  for name, ms in run.get("query_ms", {}).items()]
+        for name, higher_is_better, old_value, new_value in pairs:
+            if not old_value or new_value is None:
+                continue
+            if name.startswith("query: ") and abs(new_value - old_value) < min_query_ms:
+                continue
+            change = (new_value - old_value) / old_value
+            if abs(change) <= tolerance:
+                continue
+            verdict = "better" if (change > 0) == higher_is_better else "REGRESSION"
+            print(f"{size:>10} {name}: {old_value} -> {new_value} ({change:+.0%}, {verdict})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_parse = sub.add_parser("parse", help="Streaming parser throughput")
+    p_parse.add_argument("path", nargs="?", default="cvs.txt")
+
+    p_timestamps = sub.add_parser("timestamps", help="strptime vs normalize_timestamp")
+    p_timestamps.add_argument("path", nargs="?", default="cvs.txt")
+
+    p_ingest = sub.add_parser("ingest", help="store_message vs BulkLoader")
+    p_ingest.add_argument("path", nargs="?", default="cvs.txt")
+    p_ingest.add_argument("--limit", type=int, default=20000,
+                          help="messages to load (store_message is slow); 0 = all")
+
+    p_scaling = sub.add_parser("scaling", help="split.ingest with 1..N parser processes")
+    p_scaling.add_argument("paths", nargs="*", default=["cvs.txt"])
+    p_scaling.add_argument("--max-workers", type=int, default=os.cpu_count())
+    p_scaling.add_argument("--chunk-mb", type=int, default=16)
+
+    p_queries = sub.add_parser("queries", help="EXPLAIN QUERY PLAN + timings")
+    p_queries.add_argument("db", nargs="?", default="chat_data.db")
+    p_queries.add_argument("--repeat", type=int, default=5)
+
+    p_suite = sub.add_parser("suite", help="end-to-end runs on synthetic exports, saved as JSON")
+    p_suite.add_argument("--sizes", default="10k,1M,10M", help="comma-separated message counts")
+    p_suite.add_argument("--workdir", default="bench_data", help="exports and DBs are kept here")
+    p_suite.add_argument("--output", default="benchmark_results.json")
+    p_suite.add_argument("--baseline", default=None, help="earlier results file to compare against")
+    p_suite.add_argument("--workers", type=int, default=os.cpu_count())
+    p_suite.add_argument("--classify-limit", type=int, default=200000,
+                         help="messages classified per size (the fake LLM is still HTTP)")
+    p_suite.add_argument("--llm-latency", type=float, default=0.05)
+    p_suite.add_argument("--error-rate", type=float, default=0.01)
+    p_suite.add_argument("--throttle-rate", type=float, default=0.01)
+
+    args = parser.parse_args()
+    if args.command == "parse":
+        bench_parse(args.path)
+    elif args.command == "timestamps":
+        bench_timestamps(args.path)
+    elif args.command == "ingest":
+        bench_ingest(args.path, args.limit)
+    elif args.command == "scaling":
+        bench_scaling(args.paths, args.max_workers, args.chunk_mb)
+    elif args.command == "queries":
+        bench_queries(args.db, args.repeat)
+    elif args.command == "suite":
+        bench_suite([parse_size(size) for size in args.sizes.split(",")], args.workdir, args.output,
+                    args.baseline, args.workers, args.classify_limit, args.llm_latency,
+                    args.error_rate, args.throttle_rate)
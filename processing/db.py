@@ -1,19 +1,86 @@
+import hashlib
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from urllib.request import pathname2url
 
+import metrics
 
-def setup_database(db_name="chat_data.db"):
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-    
+
+def content_hash(content):
+    """Short, stable hash of a message body used for de-duplication."""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def source_name(path):
+    """Chat name stored in messages.source for an export file: its base name without extension."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+TIMESTAMP_FORMATS = "DD/MM/YYYY HH:MM, DD/MM/YY HH:MM, optionally with :SS"
+
+# Messages sent in the same minute share their timestamp string, so most
+# calls are cache hits.
+@lru_cache(maxsize=4096)
+def normalize_timestamp(raw_timestamp):
+    """
+    'DD/MM/YYYY HH:MM' -> 'YYYY-MM-DD HH:MM:SS' by slicing the fixed-width
+    fields instead of strptime. 2-digit years (20YY) and seconds are
+    accepted too. Raises ValueError on anything else, or on impossible dates.
+    """
+    date, _, clock = raw_timestamp.partition(" ")
+    if len(date) == 8:
+        day, month, year = date[0:2], date[3:5], "20" + date[6:8]
+    elif len(date) == 10:
+        day, month, year = date[0:2], date[3:5], date[6:10]
+    else:
+        raise ValueError(f"unknown date {date!r}")
+    if len(clock) == 5:
+        clock += ":00"
+    elif len(clock) != 8:
+        raise ValueError(f"unknown time {clock!r}")
+    if date[2] != "/" or date[5] != "/" or clock[2] != ":" or clock[5] != ":":
+        raise ValueError(f"unknown timestamp {raw_timestamp!r}")
+    digits = year + month + day + clock[0:2] + clock[3:5] + clock[6:8]
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f"unknown timestamp {raw_timestamp!r}")
+    if not (1 <= int(month) <= 12 and 1 <= int(day) <= 28 and clock < "24:00:00"
+            and clock[3] < "6" and clock[6] < "6"):
+        # rare or invalid: let datetime say whether e.g. 29/02 exists
+        datetime(int(year), int(month), int(day), int(clock[0:2]), int(clock[3:5]), int(clock[6:8]))
+    return f"{year}-{month}-{day} {clock}"
+
+
+def _ensure_column(c, table, column, declaration):
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+    return False
+
+
+# ---------------------------------------------------------
+# SCHEMA MIGRATIONS
+# Each migration runs once, in order, and bumps PRAGMA user_version.
+# They are written to be safe on databases that predate the versioning
+# (CREATE ... IF NOT EXISTS, column checks), since those start at version 0.
+# Never edit a released migration: append a new one.
+# ---------------------------------------------------------
+def _migration_001_base_schema(c):
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ssn TEXT UNIQUE NOT NULL
         )
     """)
-    
+
     # Updated: 'type' is now INTEGER (still allows NULL)
     c.execute("""
         CREATE TABLE IF NOT EXISTS messages (
@@ -25,81 +92,780 @@ def setup_database(db_name="chat_data.db"):
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     """)
-    conn.commit()
+
+
+def _ensure_occurrence(c):
+    """
+    Adds messages.occurrence, which numbers repeats of the same message
+    (same user, timestamp and content) in a chat: two "kkkk" or two photos
+    sent in the same minute are 0 and 1, so both are kept. Rows that already
+    repeat when the column is added are numbered by id and only marked in
+    suspected_duplicates (left by full re-runs of the old split.py, or
+    legitimate repeats: there is no telling them apart). Migrations never
+    delete messages; `maintenance.py dedup` removes the marked ones.
+    """
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS suspected_duplicates (
+            message_id INTEGER PRIMARY KEY,
+            original_id INTEGER NOT NULL
+        )
+    """)
+    if not _ensure_column(c, "messages", "occurrence", "INTEGER NOT NULL DEFAULT 0"):
+        return
+    columns = [row[1] for row in c.execute("PRAGMA table_info(messages)")]
+    key = "user_id, timestamp, content_hash" + (", source" if "source" in columns else "")
+    c.execute(f"""
+        CREATE TEMP TABLE numbered_messages AS
+        SELECT * FROM (
+            SELECT id, ROW_NUMBER() OVER w - 1 AS occurrence, MIN(id) OVER w AS original_id
+            FROM messages WINDOW w AS (PARTITION BY {key} ORDER BY id)
+        ) WHERE occurrence > 0
+    """)
+    c.execute("""
+        UPDATE messages SET occurrence = n.occurrence
+        FROM numbered_messages n WHERE n.id = messages.id
+    """)
+    c.execute("""
+        INSERT OR IGNORE INTO suspected_duplicates (message_id, original_id)
+        SELECT id, original_id FROM numbered_messages
+    """)
+    c.execute("DROP TABLE numbered_messages")
+    if c.execute("SELECT COUNT(*) FROM suspected_duplicates").fetchone()[0]:
+        print("Repeated messages were kept and marked in suspected_duplicates"
+              " (review, then remove with: python maintenance.py dedup)")
+
+
+def _migration_002_incremental_ingestion(c):
+    # Backfill content_hash and drop exact duplicates left by repeated full
+    # re-runs, otherwise the uniqueness key below cannot be created.
+    if _ensure_column(c, "messages", "content_hash", "TEXT"):
+        c.connection.create_function("content_hash", 1, content_hash, deterministic=True)
+        c.execute("UPDATE messages SET content_hash = content_hash(content)")
+        c.execute("""
+            DELETE FROM messages WHERE id NOT IN (
+                SELECT MIN(id) FROM messages GROUP BY user_id, timestamp, content_hash
+            )
+        """)
+        if c.rowcount > 0:
+            print(f"Removed {c.rowcount} duplicate messages")
+
+    # (user_id, timestamp, content_hash) identifies a message across re-ingestions
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_dedup
+        ON messages (user_id, timestamp, content_hash)
+    """)
+
+    # High-water mark per export file, used by incremental ingestion
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sources (
+            path TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            last_offset INTEGER NOT NULL,
+            last_timestamp TEXT,
+            last_hash TEXT,
+            updated_at TEXT NOT NULL
+        )
+    """)
+
+
+def _migration_003_query_indexes(c):
+    # Classifier backlog: only untagged rows live in this index, so it stays
+    # small as the backlog drains.
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_untagged
+        ON messages (id) WHERE type IS NULL
+    """)
+    # Dashboard: ORDER BY timestamp and date ranges
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)")
+    # Per-type filters ordered by time
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_type_timestamp ON messages (type, timestamp)")
+    # Per-user filters ordered by time are already served by idx_messages_dedup,
+    # whose leading columns are (user_id, timestamp).
+    c.execute("ANALYZE")
+
+
+def _migration_004_classification_cache(c):
+    # Label per normalized content hash (see async_deepseek_classifier.cache_key)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS classification_cache (
+            hash TEXT PRIMARY KEY,
+            type INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_005_label_source(c):
+    # Who set messages.type: 'heuristic' (ingestion), 'rule'/'model' (local
+    # prefilter), 'llm' or 'cache'. NULL on rows labeled before this column
+    # existed, which all came from the ingestion heuristic or the LLM.
+    _ensure_column(c, "messages", "label_source", "TEXT")
+
+
+def _migration_006_dead_letters(c):
+    # Messages the classifier gave up on, with the last error. They are
+    # skipped by iter_untagged_messages until retried explicitly.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id),
+            error TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            failed_at TEXT NOT NULL
+        )
+    """)
+    # A message that eventually gets a label is no longer dead
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_messages_labeled_clears_dead_letter
+        AFTER UPDATE OF type ON messages
+        WHEN NEW.type IS NOT NULL
+        BEGIN
+            DELETE FROM dead_letters WHERE message_id = NEW.id;
+        END
+    """)
+
+
+def _migration_007_daily_counts(c):
+    # Message counts per (day, type, user), kept in sync by triggers so every
+    # writer (ingestion, classifier, maintenance) maintains it for free.
+    # Untagged messages are counted under type -1.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_counts (
+            day TEXT NOT NULL,
+            type INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, type, user_id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("DELETE FROM daily_counts")
+    c.execute("""
+        INSERT INTO daily_counts (day, type, user_id, count)
+        SELECT date(timestamp), COALESCE(type, -1), user_id, COUNT(*)
+        FROM messages GROUP BY 1, 2, 3
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_counts_insert
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO daily_counts (day, type, user_id, count)
+            VALUES (date(NEW.timestamp), COALESCE(NEW.type, -1), NEW.user_id, 1)
+            ON CONFLICT (day, type, user_id) DO UPDATE SET count = count + 1;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_counts_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE daily_counts SET count = count - 1
+            WHERE day = date(OLD.timestamp) AND type = COALESCE(OLD.type, -1) AND user_id = OLD.user_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_counts_update
+        AFTER UPDATE OF type, user_id, timestamp ON messages
+        WHEN OLD.type IS NOT NEW.type OR OLD.user_id != NEW.user_id OR OLD.timestamp != NEW.timestamp
+        BEGIN
+            UPDATE daily_counts SET count = count - 1
+            WHERE day = date(OLD.timestamp) AND type = COALESCE(OLD.type, -1) AND user_id = OLD.user_id;
+            INSERT INTO daily_counts (day, type, user_id, count)
+            VALUES (date(NEW.timestamp), COALESCE(NEW.type, -1), NEW.user_id, 1)
+            ON CONFLICT (day, type, user_id) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+
+def _migration_008_full_text_search(c):
+    # FTS5 index over messages.content for the dashboard search. It is an
+    # external-content table (the text lives only in messages); triggers keep
+    # it in sync. remove_diacritics makes "medico" match "médico".
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+        AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END
+    """)
+    # Only content edits touch the index; labeling (UPDATE OF type) does not
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update
+        AFTER UPDATE OF content ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    """)
+
+
+def _migration_009_data_version(c):
+    # Counter bumped whenever existing rows change (relabel, edit, delete,
+    # user rename), so caches built from the DB know when to rebuild.
+    # Plain inserts don't bump it: readers detect those by max(messages.id)
+    # and can refresh incrementally.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0)")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_meta_messages_update
+        AFTER UPDATE OF type, user_id, timestamp, content ON messages
+        BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_meta_messages_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_meta_users_update
+        AFTER UPDATE OF ssn ON users
+        BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+        END
+    """)
+
+
+def _migration_010_message_source(c):
+    # Several chats can live in one DB: messages.source is the chat (export
+    # file name, see source_name) and is part of the dedup key, so the same
+    # text posted to two groups is kept twice. Existing rows came from the
+    # single file ingested so far (cvs.txt unless sources says otherwise).
+    if _ensure_column(c, "messages", "source", "TEXT NOT NULL DEFAULT ''"):
+        paths = [row[0] for row in c.execute("SELECT path FROM sources")]
+        legacy = source_name(paths[0]) if len(paths) == 1 else "cvs"
+        c.execute("UPDATE messages SET source = ?", (legacy,))
+    c.execute("DROP INDEX IF EXISTS idx_messages_dedup")
+    # Leading (user_id, timestamp) still serves per-user filters
+    c.execute("""
+        CREATE UNIQUE INDEX idx_messages_dedup
+        ON messages (user_id, timestamp, content_hash, source)
+    """)
+
+    # Per-row index/rollup maintenance made the single ingestion writer the
+    # bottleneck. While BulkLoader inserts a batch it sets meta.bulk_load
+    # (never committed) and maintains messages_fts and daily_counts itself,
+    # with one set-based statement per batch.
+    c.execute("DROP TRIGGER IF EXISTS trg_messages_fts_insert")
+    c.execute("""
+        CREATE TRIGGER trg_messages_fts_insert
+        AFTER INSERT ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'bulk_load')
+        BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    """)
+    c.execute("DROP TRIGGER IF EXISTS trg_daily_counts_insert")
+    c.execute("""
+        CREATE TRIGGER trg_daily_counts_insert
+        AFTER INSERT ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'bulk_load')
+        BEGIN
+            INSERT INTO daily_counts (day, type, user_id, count)
+            VALUES (date(NEW.timestamp), COALESCE(NEW.type, -1), NEW.user_id, 1)
+            ON CONFLICT (day, type, user_id) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+
+def _migration_011_near_duplicates(c):
+    # MinHash LSH index (see near_dup.py). cluster_id is the id of the first
+    # message of the cluster. near_dup_bands holds the first message seen
+    # per band hash only, which bounds the candidates of any lookup.
+    # Labels propagated through a cluster have label_source 'near_dup'.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS near_dup_signatures (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id),
+            cluster_id INTEGER NOT NULL,
+            signature BLOB NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_near_dup_cluster ON near_dup_signatures (cluster_id)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS near_dup_bands (
+            band_key INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        )
+    """)
+
+
+def _migration_012_user_aliases(c):
+    # pipeline.py anonymizes senders before they are stored: users.ssn is
+    # already "Pessoa N", and this maps a keyed hash of the original name
+    # (key in meta.alias_key) to that alias, so the same sender keeps it
+    # across runs without the name ever being written.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_aliases (
+            name_hash TEXT PRIMARY KEY,
+            alias TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_013_message_occurrence(c):
+    # Databases that went through 002/010 before they numbered repeated
+    # messages: their key had no occurrence, so every row is occurrence 0.
+    _ensure_occurrence(c)
+    c.execute("DROP INDEX IF EXISTS idx_messages_dedup")
+    c.execute("""
+        CREATE UNIQUE INDEX idx_messages_dedup
+        ON messages (user_id, timestamp, content_hash, source, occurrence)
+    """)
+
+
+def _migration_014_alias_key_out_of_db(c):
+    # pipeline.py used to keep the user_aliases key in meta.alias_key. Next
+    # to the hashes it made them reversible: sender names are mostly phone
+    # numbers, a few million candidates per area code. The key now comes
+    # from the environment (pipeline.alias_key); the stored one and every
+    # hash made with it are dropped, so those senders get new aliases.
+    if c.execute("DELETE FROM meta WHERE key = 'alias_key'").rowcount:
+        c.execute("DELETE FROM user_aliases")
+        print(f"Dropped the alias key stored in the database and {c.rowcount} reversible alias hashes")
+
+
+def _migration_015_dedup_key_occurrence(c):
+    # 002 and 010 stay as released, with no occurrence in the key; 013 added
+    # it to the databases that ran them. This checks the key on every
+    # database, whichever path it came through, and rebuilds it if it is not
+    # the full one.
+    _ensure_occurrence(c)
+    key = [row[2] for row in c.execute("PRAGMA index_info(idx_messages_dedup)")]
+    if key != ["user_id", "timestamp", "content_hash", "source", "occurrence"]:
+        c.execute("DROP INDEX IF EXISTS idx_messages_dedup")
+        c.execute("""
+            CREATE UNIQUE INDEX idx_messages_dedup
+            ON messages (user_id, timestamp, content_hash, source, occurrence)
+        """)
+
+
+MIGRATIONS = [
+    _migration_001_base_schema,
+    _migration_002_incremental_ingestion,
+    _migration_003_query_indexes,
+    _migration_004_classification_cache,
+    _migration_005_label_source,
+    _migration_006_dead_letters,
+    _migration_007_daily_counts,
+    _migration_008_full_text_search,
+    _migration_009_data_version,
+    _migration_010_message_source,
+    _migration_011_near_duplicates,
+    _migration_012_user_aliases,
+    _migration_013_message_occurrence,
+    _migration_014_alias_key_out_of_db,
+    _migration_015_dedup_key_occurrence,
+]
+
+
+def _backup_before_dedup(conn):
+    """
+    Released migration 002 deletes exact repeats from databases that predate
+    content_hash (full re-runs of the old split.py, but also legitimate
+    repeats). Such a database is copied to <file>.pre-migration first, so no
+    message is lost for good.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+    path = database_path(conn)
+    if not columns or "content_hash" in columns or not path:
+        return
+    if not conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+        return
+    backup = sqlite3.connect(f"{path}.pre-migration")
+    try:
+        conn.backup(backup)
+    finally:
+        backup.close()
+    print(f"Copied the database to {path}.pre-migration before migrating it")
+
+
+def migrate(conn):
+    """Applies pending migrations, each in its own transaction."""
+    c = conn.cursor()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version < 2:
+        _backup_before_dedup(conn)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            c.execute("BEGIN")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    if version < len(MIGRATIONS):
+        print(f"Database schema migrated from version {version} to {len(MIGRATIONS)}")
     return conn
 
-def get_untagged_messages(conn, limit=100):
+
+def database_path(conn):
+    """File behind a connection, e.g. to open a ResultWriter on the same DB."""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def setup_database(db_name="chat_data.db"):
     """
-    Retrieves ID and Content for messages where 'type' is NULL.
-    
-    Args:
-        conn: The database connection.
-        limit (int): The maximum number of messages to retrieve. Defaults to 100.
+    Opens the DB for the ingest/classify/maintenance CLIs: migrates it and
+    puts it in WAL mode, where writers never block dashboard readers.
+    """
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    c.execute("PRAGMA foreign_keys = ON;")
+    migrate(conn)
+    c.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+class ReadPool:
+    """
+    Read-only connections shared by every dashboard session. Each one is
+    opened with mode=ro and query_only, and memory-maps the file, so pages
+    are shared with the OS cache instead of copied per connection. In WAL
+    mode readers never wait for a writer (ingestion, classifier) and never
+    block it. At most `size` connections exist; when all are busy,
+    connection() waits for one to be returned.
+
+    Usage:
+        pool = ReadPool("chat_data.db")
+        with pool.connection() as conn:
+            conn.execute("SELECT ...")
+    """
+
+    def __init__(self, db_name="chat_data.db", size=8, mmap_size=256 * 1024 * 1024):
+        self.uri = f"file:{pathname2url(os.path.abspath(db_name))}?mode=ro"
+        self.size = size
+        self.mmap_size = mmap_size
+        self.idle = queue.LifoQueue()  # most recently used first: its pages are warm
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # Handed from session thread to session thread, never used by two at once
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                self.opened += can_open
+            if not can_open:
+                conn = self.idle.get()
+            else:
+                try:
+                    conn = self._connect()
+                except sqlite3.Error:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+# ---------------------------------------------------------
+# QUERIES
+# Every statement the pipeline and the dashboard issue lives in a constant
+# here (or in near_dup.py), so benchmark.py times the exact shipped SQL.
+# {where} is filled with message_filters; {placeholders} with one ? per key.
+# ---------------------------------------------------------
+SOURCE_SQL = "SELECT offset, last_offset, last_timestamp, last_hash FROM sources WHERE path = ?"
+SOURCE_MARK_SQL = """
+    INSERT OR REPLACE INTO sources
+        (path, offset, last_offset, last_timestamp, last_hash, updated_at)
+    VALUES (?, ?, ?, ?, ?, datetime('now'))
+"""
+UNTAGGED_FILTER = """
+    type IS NULL AND (? OR NOT EXISTS (SELECT 1 FROM dead_letters d WHERE d.message_id = messages.id))
+"""
+# INDEXED BY: left alone, the planner picks idx_messages_type_timestamp
+# (type=?) and sorts the whole remaining backlog for every page
+UNTAGGED_PAGE_SQL = f"""
+    SELECT id, content FROM messages INDEXED BY idx_messages_untagged
+    WHERE {UNTAGGED_FILTER} AND id > ?
+    ORDER BY id LIMIT ?
+"""
+COUNT_UNTAGGED_SQL = f"SELECT COUNT(*) FROM messages WHERE {UNTAGGED_FILTER}"
+MESSAGE_CONTENTS_SQL = "SELECT id, content FROM messages WHERE id IN (SELECT value FROM json_each(?))"
+TRAINING_MESSAGES_SQL = """
+    SELECT content, type FROM messages
+    WHERE type IS NOT NULL AND type NOT IN (4, 5)
+      AND (label_source IS NULL OR label_source IN ('llm', 'cache'))
+    ORDER BY id DESC LIMIT ?
+"""
+DATA_VERSION_SQL = "SELECT value FROM meta WHERE key = 'data_version'"
+MAX_MESSAGE_ID_SQL = "SELECT COALESCE(MAX(id), 0) FROM messages"
+FIRST_DAY_AFTER_SQL = "SELECT MIN(date(timestamp)) FROM messages WHERE id > ?"
+DAILY_COUNTS_SQL = """
+    SELECT r.day, r.type, u.ssn, r.count
+    FROM daily_counts r JOIN users u ON r.user_id = u.id
+    WHERE r.count > 0 AND r.day >= ?
+"""
+SEARCH_FROM = """
+    FROM messages_fts f
+    JOIN messages m ON m.id = f.rowid
+    JOIN users u ON u.id = m.user_id
+    WHERE messages_fts MATCH ? AND {where}
+"""
+SEARCH_COUNT_SQL = "SELECT COUNT(*) " + SEARCH_FROM
+SEARCH_SQL = "SELECT m.id, m.timestamp, u.ssn, m.type, m.content " + SEARCH_FROM + """
+    ORDER BY f.rank LIMIT ? OFFSET ?
+"""
+BROWSE_SQL = """
+    SELECT m.id, m.timestamp, u.ssn, m.type, m.content
+    FROM messages m JOIN users u ON u.id = m.user_id
+    WHERE {where}
+    ORDER BY m.timestamp DESC, m.id DESC LIMIT ?
+"""
+BROWSE_BEFORE = " AND (m.timestamp, m.id) < (?, ?)"
+CAMPAIGNS_SQL = """
+    SELECT s.cluster_id, COUNT(*) AS reposts, COUNT(DISTINCT m.user_id),
+           MIN(m.timestamp), MAX(m.timestamp), r.type, r.content
+    FROM near_dup_signatures s
+    JOIN messages m ON m.id = s.message_id
+    JOIN users u ON u.id = m.user_id
+    JOIN messages r ON r.id = s.cluster_id
+    WHERE s.cluster_id IN (
+        -- big clusters first, from the index alone: most messages are singletons
+        SELECT cluster_id FROM near_dup_signatures GROUP BY cluster_id HAVING COUNT(*) >= ?
+    ) AND {where}
+    GROUP BY s.cluster_id
+    HAVING COUNT(*) >= ?
+    ORDER BY reposts DESC LIMIT ?
+"""
+USER_INSERT_SQL = "INSERT OR IGNORE INTO users (ssn) VALUES (?)"
+USER_ID_SQL = "SELECT id FROM users WHERE ssn = ?"
+MESSAGE_INSERT_SQL = """
+    INSERT OR IGNORE INTO messages
+        (user_id, timestamp, content, type, content_hash, label_source, source, occurrence)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+# BulkLoader's set-based catch-up of what the muted insert triggers would do
+BULK_FTS_SQL = """
+    INSERT INTO messages_fts (rowid, content)
+    SELECT id, content FROM messages WHERE id > ?
+"""
+BULK_DAILY_COUNTS_SQL = """
+    INSERT INTO daily_counts (day, type, user_id, count)
+    SELECT date(timestamp), COALESCE(type, -1), user_id, COUNT(*)
+    FROM messages WHERE id > ? GROUP BY 1, 2, 3
+    ON CONFLICT (day, type, user_id) DO UPDATE SET count = count + excluded.count
+"""
+CACHE_LOOKUP_SQL = "SELECT hash, type FROM classification_cache WHERE hash IN ({placeholders})"
+CACHE_INSERT_SQL = "INSERT OR REPLACE INTO classification_cache (hash, type) VALUES (?, ?)"
+UPDATE_TYPE_SQL = "UPDATE messages SET type = ?, label_source = ? WHERE id = ?"
+DEAD_LETTER_SQL = """
+    INSERT INTO dead_letters (message_id, error, attempts, failed_at)
+    VALUES (?, ?, 1, datetime('now'))
+    ON CONFLICT (message_id) DO UPDATE SET
+        error = excluded.error,
+        attempts = dead_letters.attempts + 1,
+        failed_at = excluded.failed_at
+"""
+
+def get_source(conn, path):
+    """
+    Returns the high-water mark stored for an export file as
+    (offset, last_offset, last_timestamp, last_hash), or None if never ingested.
+    """
+    c = conn.cursor()
+    c.execute(SOURCE_SQL, (path,))
+    return c.fetchone()
+
+def iter_untagged_messages(conn, after_id=0, page_size=1000, include_dead_letters=False):
+    """
+    Streams (id, content) of untagged messages in id order using keyset
+    pagination (id > last seen id). Each page is a range search of the
+    partial idx_messages_untagged (id>?) that stops after `page_size` rows,
+    with no sort, so it costs the same however large the backlog is.
+    Dead-lettered messages are skipped unless `include_dead_letters` is set.
+    """
+    c = conn.cursor()
+    while True:
+        c.execute(UNTAGGED_PAGE_SQL, (include_dead_letters, after_id, page_size))
+        rows = c.fetchall()
+        if not rows:
+            return
+        yield from rows
+        after_id = rows[-1][0]
+
+def count_untagged_messages(conn, include_dead_letters=False):
+    c = conn.cursor()
+    c.execute(COUNT_UNTAGGED_SQL, (include_dead_letters,))
+    return c.fetchone()[0]
+
+def get_message_contents(conn, message_ids):
+    """{id: content} of the given message ids."""
+    c = conn.cursor()
+    c.execute(MESSAGE_CONTENTS_SQL, (json.dumps(list(message_ids)),))
+    return dict(c.fetchall())
+
+def get_training_messages(conn, limit=200000):
+    """
+    Returns (content, type) of the most recent messages labeled by the LLM,
+    for training the local prefilter. Stickers/media and labels produced by
+    the prefilter itself are left out.
     """
     c = conn.cursor()
-    # Added 'LIMIT ?' to the query
-    c.execute("SELECT id, content FROM messages WHERE type IS NULL LIMIT ?", (limit,))
+    c.execute(TRAINING_MESSAGES_SQL, (limit,))
     return c.fetchall()
 
-def get_messages(conn, limit=100):
+def get_data_version(conn):
     """
-    Retrieves ID and Content for messages.
-    
-    Args:
-        conn: The database connection.
-        limit (int): The maximum number of messages to retrieve. Defaults to 100.
+    (data_version, max message id): unchanged means nothing changed; only a
+    larger max id means messages were appended and nothing else was touched.
     """
     c = conn.cursor()
-    # Added 'LIMIT ?' to the query
-    c.execute("SELECT id, content, type FROM messages LIMIT ?", (limit,))
+    version = c.execute(DATA_VERSION_SQL).fetchone()[0]
+    max_id = c.execute(MAX_MESSAGE_ID_SQL).fetchone()[0]
+    return version, max_id
+
+def get_first_day_after(conn, after_id):
+    """Earliest day touched by messages with id > after_id, or None."""
+    c = conn.cursor()
+    c.execute(FIRST_DAY_AFTER_SQL, (after_id,))
+    return c.fetchone()[0]
+
+def get_daily_counts(conn, since_day=None):
+    """
+    (day, type, user_ssn, count) rows of the daily_counts rollup, optionally
+    only from `since_day` (YYYY-MM-DD) on. Untagged messages have type -1.
+    """
+    c = conn.cursor()
+    c.execute(DAILY_COUNTS_SQL, (since_day or "",))
     return c.fetchall()
 
-def update_message_type(conn, message_id, new_type):
+def message_filters(start=None, end=None, users=None, types=None):
     """
-    Updates the type of a specific message.
-    
-    Args:
-        message_id (int): The ID of the message to update.
-        new_type (int): The integer type to assign.
+    WHERE clause + params for the dashboard filters, over messages m joined
+    with users u. `start`/`end` are inclusive dates; `users` (ssn) and
+    `types` (codes, -1 = untagged) are lists, or None for "all". Lists are
+    passed as one JSON parameter so the statement text never changes.
     """
-    try:
-        c = conn.cursor()
-        c.execute("UPDATE messages SET type = ? WHERE id = ?", (new_type, message_id))
-        conn.commit()
-        # Check if any row was actually modified
-        if c.rowcount == 0:
-            print(f"Warning: No message found with ID {message_id}")
-        # else:
-            # print(f"Updated Message {message_id} to type {new_type}")
-            
-    except sqlite3.Error as e:
-        print(f"Database Update Error: {e}")
+    clauses, params = [], []
+    if start is not None:
+        clauses.append("m.timestamp >= ?")
+        params.append(start.strftime('%Y-%m-%d'))
+    if end is not None:
+        clauses.append("m.timestamp < date(?, '+1 day')")
+        params.append(end.strftime('%Y-%m-%d'))
+    if users is not None:
+        clauses.append("u.ssn IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(users)))
+    if types is not None:
+        clauses.append("COALESCE(m.type, -1) IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps([int(t) for t in types]))
+    return " AND ".join(clauses) or "1", params
+
+SEARCH_TOKEN = re.compile(r"\w+")
+
+def fts_query(text):
+    """
+    Turns free text typed by a user into an FTS5 MATCH expression: every
+    word must appear (quoted, so operators and punctuation are literal) and
+    the last one is a prefix, for search-as-you-type. None if no words.
+    """
+    words = SEARCH_TOKEN.findall(text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def search_messages(conn, text, limit=50, offset=0, **filters):
+    """
+    Full-text search ranked by bm25. Returns (total matches, page of rows);
+    rows are (id, timestamp, user_ssn, type, content). See message_filters
+    for the accepted filters.
+    """
+    match = fts_query(text)
+    if match is None:
+        return 0, []
+    where, params = message_filters(**filters)
+    c = conn.cursor()
+    total = c.execute(SEARCH_COUNT_SQL.format(where=where), [match, *params]).fetchone()[0]
+    c.execute(SEARCH_SQL.format(where=where), [match, *params, limit, offset])
+    return total, c.fetchall()
+
+def browse_messages(conn, before=None, limit=500, **filters):
+    """
+    One page of the message browser, newest first. Keyset pagination on
+    (timestamp, id): `before` is the (timestamp, id) of the last row of the
+    previous page, so every page is an index range scan on
+    idx_messages_timestamp however deep the user scrolls. Rows are
+    (id, timestamp, user_ssn, type, content).
+    """
+    where, params = message_filters(**filters)
+    if before is not None:
+        where += BROWSE_BEFORE
+        params += list(before)
+    c = conn.cursor()
+    c.execute(BROWSE_SQL.format(where=where), [*params, limit])
+    return c.fetchall()
+
+def get_campaigns(conn, min_reposts=3, limit=50, **filters):
+    """
+    Near-duplicate clusters (see near_dup.py) with at least `min_reposts`
+    messages matching the filters, biggest first. Rows are (cluster_id,
+    reposts, distinct users, first seen, last seen, type, content), type
+    and content being those of the cluster's first message.
+    """
+    where, params = message_filters(**filters)
+    c = conn.cursor()
+    c.execute(CAMPAIGNS_SQL.format(where=where), [min_reposts, *params, min_reposts, limit])
+    return c.fetchall()
 
-def store_message(conn, ssn, raw_timestamp, content, msg_type=None):
+def store_message(conn, ssn, raw_timestamp, content, msg_type=None, source=""):
     """
     Takes a raw timestamp in 'DD/MM/YYYY HH:MM' format, converts it to
-    'YYYY-MM-DD HH:MM:SS', and stores the message.
+    'YYYY-MM-DD HH:MM:SS', and stores the message. A row can't know its
+    place among repeats here, so it is stored as occurrence 0 (a second
+    identical message in the same minute is skipped); BulkLoader numbers them.
     
     Args:
         msg_type (int, optional): The numeric category of the message. Defaults to None.
+        source (str, optional): The chat the message belongs to (see source_name).
     """
     try:
-        # 1. Parse the input format (Day/Month/Year Hour:Minute)
-        dt_object = datetime.strptime(raw_timestamp, "%d/%m/%Y %H:%M")
-        
-        # 2. Convert to ISO format (Year-Month-Day Hour:Minute:Second)
-        iso_timestamp = dt_object.strftime("%Y-%m-%d %H:%M:%S")
-        
+        # Day/Month/Year Hour:Minute -> Year-Month-Day Hour:Minute:Second
+        iso_timestamp = normalize_timestamp(raw_timestamp)
     except ValueError as e:
-        print(f"Timestamp Error: {e} | Format must be DD/MM/YYYY HH:MM")
+        print(f"Timestamp Error: {e} | Format must be {TIMESTAMP_FORMATS}")
         return
 
     c = conn.cursor()
     
     # Handle User ID
     try:
-        c.execute("INSERT OR IGNORE INTO users (ssn) VALUES (?)", (ssn,))
-        c.execute("SELECT id FROM users WHERE ssn = ?", (ssn,))
+        c.execute(USER_INSERT_SQL, (ssn,))
+        c.execute(USER_ID_SQL, (ssn,))
         user_id = c.fetchone()[0]
     except sqlite3.Error as e:
         print(f"Database Error (User): {e}")
@@ -107,10 +873,276 @@ def store_message(conn, ssn, raw_timestamp, content, msg_type=None):
 
     # Store Message
     try:
-        c.execute("""
-            INSERT INTO messages (user_id, timestamp, content, type) 
-            VALUES (?, ?, ?, ?)
-        """, (user_id, iso_timestamp, content, msg_type))
+        c.execute(MESSAGE_INSERT_SQL, (user_id, iso_timestamp, content, msg_type, content_hash(content),
+                                       None if msg_type is None else "heuristic", source, 0))
         conn.commit()
     except sqlite3.Error as e:
-        print(f"Database Error (Message): {e}")
\ No newline at end of file
+        print(f"Database Error (Message): {e}")
+
+
+DB_INSERT_SECONDS = metrics.histogram("db_insert_seconds", "Time to write one batch of rows")
+DB_COMMIT_SECONDS = metrics.histogram("db_commit_seconds", "Time to commit a transaction")
+DB_ROWS = metrics.counter("db_rows_total", "Rows handed to the bulk writers, by table and result")
+DB_WRITER_QUEUE = metrics.gauge("db_writer_queue_depth", "Chunks waiting for the result writer thread")
+WRITTEN_TABLE = re.compile(r"\b(?:INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+
+class BulkLoader:
+    """
+    Bulk ingestion API, meant as a drop-in for calling store_message in a loop.
+
+    - users are resolved through an in-memory ssn -> user_id cache
+    - messages are buffered and written with executemany every `batch_size` rows
+    - a commit happens only every `rows_per_transaction` rows
+    - WAL + synchronous=NORMAL are enabled while the loader is open
+    - repeats of a message (same user, timestamp, content and source) are
+      numbered in the order they are added (messages.occurrence), and rows
+      already stored under the same number are skipped, so re-reading an
+      export stores nothing twice and drops nothing
+    - an optional source high-water mark is saved in the same transaction as
+      the rows it covers, so an interrupted load resumes where it committed
+    - `on_commit(loader)`, if given, runs after every commit (e.g. to tell
+      readers that new rows are visible)
+
+    Usage:
+        with BulkLoader(conn) as loader:
+            loader.add(ssn, raw_timestamp, content, msg_type)
+    """
+
+    def __init__(self, conn, batch_size=10000, rows_per_transaction=100000,
+                 synchronous="NORMAL", on_commit=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.rows_per_transaction = rows_per_transaction
+        self.synchronous = synchronous
+        self.on_commit = on_commit
+        self.user_ids = {}
+        self.pending = []
+        self.uncommitted = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.source_marks = {}
+        self.minutes = {}  # source -> (timestamp, {(user_id, content_hash): repeats so far})
+        self._previous_synchronous = None
+
+    def __enter__(self):
+        c = self.conn.cursor()
+        self._previous_synchronous = c.execute("PRAGMA synchronous").fetchone()[0]
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute(f"PRAGMA synchronous = {self.synchronous}")
+        self.user_ids = {ssn: user_id for user_id, ssn in c.execute("SELECT id, ssn FROM users")}
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+            self._commit()
+        else:
+            self.conn.rollback()
+        self.conn.execute(f"PRAGMA synchronous = {self._previous_synchronous}")
+        return False
+
+    def _user_id(self, ssn):
+        user_id = self.user_ids.get(ssn)
+        if user_id is None:
+            c = self.conn.cursor()
+            c.execute(USER_INSERT_SQL, (ssn,))
+            c.execute(USER_ID_SQL, (ssn,))
+            user_id = c.fetchone()[0]
+            self.user_ids[ssn] = user_id
+        return user_id
+
+    def add(self, ssn, raw_timestamp, content, msg_type=None, source=""):
+        """Same arguments as store_message; the row is buffered, not written."""
+        try:
+            iso_timestamp = normalize_timestamp(raw_timestamp)
+        except ValueError as e:
+            print(f"Timestamp Error: {e} | Format must be {TIMESTAMP_FORMATS}")
+            return
+        self.add_normalized(ssn, iso_timestamp, content, msg_type, content_hash(content), source)
+
+    def add_normalized(self, ssn, iso_timestamp, content, msg_type, digest, source=""):
+        """
+        Buffers a row whose timestamp is already ISO and whose content hash is
+        already computed, e.g. by parser processes (see split.parse_range).
+        """
+        user_id = self._user_id(ssn)
+        self.pending.append((
+            user_id, iso_timestamp, content, msg_type, digest,
+            None if msg_type is None else "heuristic", source,
+            self._occurrence(source, iso_timestamp, user_id, digest),
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _occurrence(self, source, iso_timestamp, user_id, digest):
+        # Exports are in time order, so only the current minute of each chat is kept
+        minute = self.minutes.get(source)
+        if minute is None or minute[0] != iso_timestamp:
+            minute = self.minutes[source] = (iso_timestamp, {})
+        repeats = minute[1]
+        occurrence = repeats.get((user_id, digest), 0)
+        repeats[(user_id, digest)] = occurrence + 1
+        return occurrence
+
+    def continue_source(self, source, iso_timestamp):
+        """
+        Call before adding rows of a chat that resumes right after its stored
+        messages (incremental ingestion): repeats of messages stored at
+        `iso_timestamp` are numbered after the stored ones instead of from 0.
+        """
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT user_id, content_hash, MAX(occurrence) + 1 FROM messages
+            WHERE timestamp = ? AND source = ? GROUP BY 1, 2
+        """, (iso_timestamp, source))
+        self.minutes[source] = (iso_timestamp, {(user_id, digest): n for user_id, digest, n in c})
+
+    def mark_source(self, path, offset, last_offset, last_timestamp, last_hash):
+        """Records how far `path` has been read; written on the next commit."""
+        self.source_marks[path] = (path, offset, last_offset, last_timestamp, last_hash)
+
+    def flush(self):
+        """Writes buffered rows and commits once a transaction is full."""
+        if self.pending:
+            start = time.perf_counter()
+            c = self.conn.cursor()
+            # New rows get ids above the current max; the insert triggers are
+            # muted while bulk_load is set and their work is done below in bulk
+            after_id = c.execute(MAX_MESSAGE_ID_SQL).fetchone()[0]
+            c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bulk_load', 1)")
+            c.executemany(MESSAGE_INSERT_SQL, self.pending)
+            inserted = c.rowcount
+            c.execute("DELETE FROM meta WHERE key = 'bulk_load'")
+            c.execute(BULK_FTS_SQL, (after_id,))
+            c.execute(BULK_DAILY_COUNTS_SQL, (after_id,))
+            self.inserted += inserted
+            self.skipped += len(self.pending) - inserted
+            DB_INSERT_SECONDS.observe(time.perf_counter() - start, table="messages")
+            DB_ROWS.inc(inserted, table="messages", result="inserted")
+            DB_ROWS.inc(len(self.pending) - inserted, table="messages", result="skipped")
+            self.uncommitted += len(self.pending)
+            self.pending = []
+
+        if self.uncommitted >= self.rows_per_transaction:
+            self._commit()
+
+    def _commit(self):
+        self.conn.executemany(SOURCE_MARK_SQL, self.source_marks.values())
+        self.source_marks = {}
+        with DB_COMMIT_SECONDS.time(writer="bulk_loader"):
+            self.conn.commit()
+        self.uncommitted = 0
+        if self.on_commit is not None:
+            self.on_commit(self)
+
+class ResultWriter(threading.Thread):
+    """
+    The only thread that writes classifier results. Producers hand it rows
+    through a queue and it applies them with executemany, committing every
+    `batch_size` rows or `flush_interval` seconds, whichever comes first.
+    This keeps a single SQLite writer (no "database is locked") and turns
+    thousands of per-row commits into a handful of transactions.
+
+    Usage:
+        writer = ResultWriter()
+        writer.start()
+        writer.update_types([(message_id, new_type), ...], source="llm")
+        writer.close()  # flushes and waits
+
+    A failed write stops the thread; the next execute_many (and close)
+    re-raises its error, so producers stop instead of queueing results
+    that will never be written.
+    """
+
+    def __init__(self, db_name="chat_data.db", batch_size=5000, flush_interval=1.0, timeout=60.0):
+        super().__init__(name="result-writer", daemon=True)
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout  # seconds to wait for another writer's lock (pipeline.py runs ingestion alongside)
+        self.queue = queue.Queue()
+        self.written = 0
+        self.transactions = 0
+        self.error = None
+
+    def execute_many(self, sql, rows):
+        """Queues `rows` for `sql`; statements are applied in submission order."""
+        if self.error is not None:
+            raise self.error
+        if rows:
+            self.queue.put((sql, list(rows)))
+
+    def update_types(self, updates, source):
+        """Queues (message_id, new_type) pairs labeled by `source` (see label_source)."""
+        self.execute_many(UPDATE_TYPE_SQL, [(new_type, source, message_id) for message_id, new_type in updates])
+
+    def dead_letter(self, failures):
+        """Queues (message_id, error) pairs for the dead_letters table."""
+        self.execute_many(DEAD_LETTER_SQL, failures)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        with metrics.profiled_thread():  # classifier DB writes, under --profile
+            self._run()
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        pending = []
+        pending_rows = 0
+        last_flush = time.monotonic()
+        try:
+            while True:
+                timeout = max(self.flush_interval - (time.monotonic() - last_flush), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = False
+
+                if item is None:
+                    if pending:
+                        self._flush(conn, pending)
+                    return
+
+                if item:
+                    # Merge consecutive chunks of the same statement into one executemany
+                    if pending and pending[-1][0] == item[0]:
+                        pending[-1][1].extend(item[1])
+                    else:
+                        pending.append(item)
+                    pending_rows += len(item[1])
+
+                if not pending:
+                    last_flush = time.monotonic()  # the timer starts with the first pending row
+                elif pending_rows >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                    self._flush(conn, pending)
+                    pending, pending_rows = [], 0
+                    last_flush = time.monotonic()
+        except Exception as e:
+            self.error = e
+            print(f"Result writer stopped: {e}")
+        finally:
+            conn.close()
+
+    def _flush(self, conn, pending):
+        DB_WRITER_QUEUE.set(self.queue.qsize())
+        try:
+            for sql, rows in pending:
+                table = WRITTEN_TABLE.search(sql).group(1)
+                with DB_INSERT_SECONDS.time(table=table):
+                    conn.executemany(sql, rows)
+                DB_ROWS.inc(len(rows), table=table, result="written")
+                self.written += len(rows)
+            with DB_COMMIT_SECONDS.time(writer="result_writer"):
+                conn.commit()
+            self.transactions += 1
+        except sqlite3.Error:
+            conn.rollback()
+            raise
@@ -0,0 +1,126 @@
+import argparse
+import json
+import random
+import re
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Stand-in for the DeepSeek/OpenAI chat completions endpoint, so the
+# classifier can be exercised locally without an API key:
+#
+#   python fake_llm_server.py --port 8000 --latency 0.5
+#   BASE_URL=http://127.0.0.1:8000 API_KEY=fake python async_deepseek_classifier.py
+#
+# Every message is answered with the "06" (generic conversation) code.
+# --error-rate and --throttle-rate make a fraction of the requests fail with
+# a 500 or a 429 (with Retry-After), to exercise the retry paths. --reject
+# answers everything with a 401, like a revoked API key.
+
+BATCH_PAYLOAD = re.compile(r"\[.*\]", re.DOTALL)
+
+
+def fake_completion(request, content):
+    prompt_chars = sum(len(m.get("content", "")) for m in request.get("messages", []))
+    return {
+        "id": f"fake-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_chars // 3,
+            "completion_tokens": len(content) // 3,
+            "total_tokens": (prompt_chars + len(content)) // 3,
+        },
+    }
+
+
+def classify(request):
+    user_message = request["messages"][-1]["content"]
+    match = BATCH_PAYLOAD.search(user_message)
+    batch = json.loads(match.group(0)) if match else []
+    return json.dumps([{"id": item["id"], "codigo": "06"} for item in batch])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    reject = False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        roll = random.random()
+        if self.reject:
+            self.send_json(401, {"error": {"message": "Incorrect API key provided", "type": "authentication_error"}})
+        elif roll < self.throttle_rate:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                           headers={"Retry-After": "1"})
+        elif roll < self.throttle_rate + self.error_rate:
+            self.send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+        else:
+            self.send_json(200, fake_completion(request, classify(request)))
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per request drowns the classifier output
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the classifier opens hundreds of connections at once
+
+
+def serve(host="127.0.0.1", port=8000, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, reject=False):
+    """Creates the server (port 0 picks a free one, see server.server_port); call serve_forever()."""
+    Handler.latency = latency
+    Handler.jitter = jitter
+    Handler.error_rate = error_rate
+    Handler.throttle_rate = throttle_rate
+    Handler.reject = reject
+    server = FakeServer((host, port), Handler)
+    print(f"Fake LLM listening on http://{host}:{server.server_port} (latency {latency}s "
+          f"+ up to {jitter}s, {error_rate:.0%} errors, {throttle_rate:.0%} throttled"
+          f"{', rejecting every request' if reject else ''})")
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake of the chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    parser.add_argument("--reject", action="store_true", help="answer every request with a 401 (bad API key)")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency, args.jitter, args.error_rate, args.throttle_rate,
+                   args.reject)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,145 @@
+import argparse
+import sqlite3
+import time
+
+from db import setup_database
+from prefilter import DETECT_TYPE_SQL, STICKER_SQL, MEDIA_SQL
+from aliases import ALIAS_GLOB, LAST_ALIAS_SQL
+import metrics
+
+# Whole-table maintenance passes, each one SQL statement in one transaction:
+#
+#   python maintenance.py anonymize [--dry-run]   # users.ssn -> "Pessoa N"
+#   python maintenance.py retag [--dry-run]       # re-apply the sticker/media heuristic
+#   python maintenance.py dedup [--dry-run]       # delete messages marked in suspected_duplicates
+#   python maintenance.py                         # only migrate the schema (every command does)
+#
+# Run anonymize right after ingesting with split.py (without --anonymize),
+# before anything reads the names.
+
+# Users not yet anonymized get "Pessoa N" by user id, numbered after the
+# highest alias in the DB, so aliases from pipeline.py/split.py --anonymize (and from
+# earlier runs) are never renumbered.
+ANONYMIZED_NAMES = f"""
+    SELECT id, 'Pessoa ' || (({LAST_ALIAS_SQL}) + ROW_NUMBER() OVER (ORDER BY id)) AS name
+    FROM users WHERE ssn NOT GLOB '{ALIAS_GLOB}'
+"""
+
+# Messages whose stored type disagrees with detect_type (untagged ones included)
+RETAG_FILTER = f"""
+    ({STICKER_SQL} OR {MEDIA_SQL}) AND type IS NOT {DETECT_TYPE_SQL}
+"""
+
+
+def anonymize(conn, dry_run=False):
+    """Replaces every user name (phone number or saved contact) not anonymized yet with "Pessoa N"."""
+    c = conn.cursor()
+    if dry_run:
+        c.execute(f"""
+            SELECT COUNT(*) FROM users JOIN ({ANONYMIZED_NAMES}) AS numbered USING (id)
+            WHERE users.ssn != numbered.name
+        """)
+        print(f"[dry run] {c.fetchone()[0]} users would be renamed")
+        return
+
+    c.execute("BEGIN")
+    try:
+        c.execute(f"""
+            UPDATE users SET ssn = numbered.name
+            FROM ({ANONYMIZED_NAMES}) AS numbered
+            WHERE users.id = numbered.id AND users.ssn != numbered.name
+        """)
+        renamed = c.rowcount
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    print(f"Renamed {renamed} users")
+
+
+def retag(conn, dry_run=False):
+    """Re-applies the sticker/media heuristic (prefilter.detect_type) to the whole table."""
+    c = conn.cursor()
+    if dry_run:
+        c.execute(f"""
+            SELECT type, {DETECT_TYPE_SQL}, COUNT(*) FROM messages
+            WHERE {RETAG_FILTER} GROUP BY 1, 2 ORDER BY 3 DESC
+        """)
+        rows = c.fetchall()
+        for old_type, new_type, count in rows:
+            print(f"[dry run] {count} messages would go from type {old_type} to {new_type}")
+        print(f"[dry run] {sum(row[2] for row in rows)} messages would be re-tagged")
+        return
+
+    c.execute("BEGIN")
+    try:
+        c.execute(f"""
+            UPDATE messages SET type = {DETECT_TYPE_SQL}, label_source = 'heuristic'
+            WHERE {RETAG_FILTER}
+        """)
+        retagged = c.rowcount
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    print(f"Re-tagged {retagged} messages")
+
+
+def dedup(conn, dry_run=False):
+    """
+    Deletes the messages listed in suspected_duplicates: repeats found when
+    the schema started numbering them (see db._ensure_occurrence). Remove a
+    row from that table to keep its message.
+    """
+    c = conn.cursor()
+    if dry_run:
+        c.execute("""
+            SELECT COUNT(*), COUNT(DISTINCT d.original_id) FROM suspected_duplicates d
+            JOIN messages m ON m.id = d.message_id
+        """)
+        print("[dry run] {} messages would be deleted (repeats of {} others)".format(*c.fetchone()))
+        return
+
+    duplicates = "SELECT message_id FROM suspected_duplicates"
+    c.execute("BEGIN")
+    try:
+        # Rows that reference the messages go first (foreign keys)
+        c.execute(f"DELETE FROM dead_letters WHERE message_id IN ({duplicates})")
+        c.execute(f"DELETE FROM near_dup_bands WHERE message_id IN ({duplicates})")
+        c.execute(f"DELETE FROM near_dup_signatures WHERE message_id IN ({duplicates})")
+        c.execute(f"DELETE FROM messages WHERE id IN ({duplicates})")
+        deleted = c.rowcount
+        c.execute("DELETE FROM suspected_duplicates")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    print(f"Deleted {deleted} duplicate messages")
+
+
+PASSES = {"anonymize": anonymize, "retag": retag, "dedup": dedup}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set-based maintenance passes over the database")
+    # No choices=: argparse rejects an empty list against them
+    parser.add_argument("passes", nargs="*", metavar="pass",
+                        help=f"any of {', '.join(PASSES)}; none only brings the schema up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would change")
+    parser.add_argument("--db", default="chat_data.db")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    unknown = set(args.passes) - PASSES.keys()
+    if unknown:
+        parser.error(f"unknown pass: {', '.join(sorted(unknown))}")
+
+    pass_seconds = metrics.histogram("maintenance_pass_seconds", "Duration of each maintenance pass")
+    connection = setup_database(args.db)
+    with metrics.instrumented(args, "maintenance"):
+        for name in args.passes:
+            start = time.perf_counter()
+            PASSES[name](connection, args.dry_run)
+            elapsed = time.perf_counter() - start
+            pass_seconds.observe(elapsed, name=name)
+            print(f"{name} took {elapsed:.2f}s")
+    connection.close()
@@ -0,0 +1,259 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Process-wide metrics for the pipeline stages (parse, DB writes, LLM calls,
+# cache...). Stages record into REGISTRY; the CLIs write a snapshot to the
+# file given with --metrics, periodically for long runs and once at exit:
+#
+#   python split.py cvs.txt --metrics ingest.prom          # Prometheus text format
+#   python async_deepseek_classifier.py --metrics run.json # JSON
+#
+# The .prom output can be picked up by node_exporter's textfile collector.
+# --profile runs the stage under cProfile + tracemalloc and prints where time
+# and memory went (the raw profile is saved as <stage>.prof). cProfile only
+# sees the thread that enabled it: worker threads wrap their body in
+# profiled_thread() to be merged into the same report.
+
+# Seconds; covers a SQLite executemany as well as a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    """Monotonic count, optionally split by labels: counter.inc(2, status="429")."""
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """[(name suffix, labels, value)] in the Prometheus sense."""
+        with self.lock:
+            return [("", dict(key), value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Current value of something that goes up and down (queue depth, batches in flight)."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Distribution of durations (or any value) in cumulative buckets, plus sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            state = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, state in self.values.items():
+                labels = dict(key)
+                for bound, count in zip(self.buckets, state):
+                    samples.append(("_bucket", {**labels, "le": str(bound)}, count))
+                samples.append(("_bucket", {**labels, "le": "+Inf"}, state[-1]))
+                samples.append(("_sum", labels, state[-2]))
+                samples.append(("_count", labels, state[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def to_prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                rendered = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{metric.name}{suffix}{{{rendered}}} {value}" if rendered
+                             else f"{metric.name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return {
+            "timestamp": time.time(),
+            "metrics": {
+                metric.name: {
+                    "type": metric.kind,
+                    "help": metric.help,
+                    "samples": [{"name": metric.name + suffix, "labels": labels, "value": value}
+                                for suffix, labels, value in metric.samples()],
+                }
+                for metric in list(self.metrics.values())
+            },
+        }
+
+    def write(self, path):
+        """Snapshot to `path`: Prometheus text if it ends in .prom, JSON otherwise."""
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=2)
+        # Written aside and renamed, so a collector never reads half a file
+        with open(path + ".tmp", "w", encoding="utf-8") as out:
+            out.write(text)
+        os.replace(path + ".tmp", path)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+_output_path = None
+
+
+def configure(path):
+    """Where flush() writes; None disables it."""
+    global _output_path
+    _output_path = path
+
+
+def flush():
+    if _output_path:
+        REGISTRY.write(_output_path)
+
+
+_thread_profiles = None  # Profiles of finished threads while profiled() runs
+
+
+@contextmanager
+def profiled_thread():
+    """
+    Profiles the calling thread for the running profiled() report, if any.
+    Only threads that finish before the report is printed are in it.
+    """
+    if _thread_profiles is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _thread_profiles.append(profiler)
+
+
+@contextmanager
+def profiled(stage, enabled=True, top=25):
+    """
+    Runs the block under cProfile and tracemalloc, then prints the `top`
+    functions by cumulative time and the allocation sites holding the most
+    memory, and saves the profile to <stage>.prof (for snakeviz & co).
+    Threads run under profiled_thread() are merged into the same profile.
+    """
+    global _thread_profiles
+    if not enabled:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    _thread_profiles = []
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(profiler)
+        for thread_profile in _thread_profiles:
+            stats.add(thread_profile)
+        threads, _thread_profiles = len(_thread_profiles), None
+        stats.dump_stats(f"{stage}.prof")
+        print(f"=== {stage}: top {top} functions by cumulative time, main thread + {threads} others"
+              f" (full profile in {stage}.prof)")
+        stats.sort_stats("cumulative").print_stats(top)
+        print(f"=== {stage}: Python memory {current / 2**20:.1f} MB at exit, {peak / 2**20:.1f} MB peak")
+        for stat in snapshot.statistics("lineno")[:10]:
+            print(f"    {stat}")
+
+
+def add_arguments(parser):
+    """--metrics / --profile, shared by every CLI of the pipeline."""
+    parser.add_argument("--metrics", metavar="PATH", default=None,
+                        help="write stage metrics to PATH (.prom = Prometheus text format, else JSON)")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile + tracemalloc and report where time and memory went"
+                             " (all threads; parser processes of --workers > 1 are not profiled)")
+
+
+@contextmanager
+def instrumented(args, stage):
+    """Applies --metrics / --profile (see add_arguments) around a CLI's work."""
+    configure(args.metrics)
+    try:
+        with profiled(stage, args.profile):
+            yield
+    finally:
+        flush()
+        if args.metrics:
+            print(f"Metrics written to {args.metrics}")
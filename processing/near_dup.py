@@ -0,0 +1,214 @@
+import argparse
+import json
+import re
+import time
+import unicodedata
+
+import numpy as np
+
+import metrics
+from db import setup_database
+
+# Near-duplicate index (MinHash + LSH) over message texts. Ads get reposted
+# with small edits (another price, emoji or phone number), which the exact
+# classification cache misses; here every message long enough to be an ad
+# gets a MinHash signature and joins the cluster of its most similar
+# earlier message, if any is similar enough. The classifier labels a whole
+# cluster from one answer, and the dashboard lists big clusters as campaigns.
+#
+# Lookup cost does not grow with the corpus: each signature is cut into
+# BANDS bands, and near_dup_bands keeps only the first message seen for
+# each band hash, so a new message is compared to at most BANDS candidates.
+#
+#   python near_dup.py            # index messages added since the last run
+#   python near_dup.py --rebuild  # drop the index and start over
+
+NUM_PERM = 64        # MinHash functions per signature
+BANDS = 16           # LSH bands of NUM_PERM // BANDS rows: candidates from ~0.5 Jaccard up
+ROWS = NUM_PERM // BANDS
+SIMILARITY = 0.7     # Estimated Jaccard needed to join a cluster
+SHINGLE = 5          # Characters per shingle
+MIN_CHARS = 40       # Shorter (normalized) texts are left out: chat, not campaigns
+MAX_CHARS = 1000     # Same truncation as the classifier
+PAGE_SIZE = 5000     # Messages indexed per transaction
+
+SHINGLE_PRIME = np.uint64(4294967291)  # Largest prime below 2**32: shingles hash to 32 bits...
+PRIME = np.uint64(4294967311)          # ...so a * x + b stays below 2**64 (first prime above 2**32)
+_rng = np.random.default_rng(1)  # fixed: signatures must be comparable across runs
+PERM_A = _rng.integers(1, 2**32, NUM_PERM, dtype=np.uint64)
+PERM_B = _rng.integers(0, 2**32, NUM_PERM, dtype=np.uint64)
+# Odd multipliers that fold each band's ROWS values into one 64-bit key
+BAND_MIX = _rng.integers(1, 2**63, (BANDS, ROWS), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+NON_WORD = re.compile(r"[\W_]+")
+DIGITS = re.compile(r"\d+")
+
+INDEXED_ID_SQL = "SELECT value FROM meta WHERE key = 'near_dup_indexed'"
+INDEXED_ID_SET_SQL = "INSERT OR REPLACE INTO meta (key, value) VALUES ('near_dup_indexed', ?)"
+INDEX_PAGE_SQL = "SELECT id, content FROM messages WHERE id > ? ORDER BY id LIMIT ?"
+BANDS_SQL = "SELECT band_key, message_id FROM near_dup_bands WHERE band_key IN (SELECT value FROM json_each(?))"
+SIGNATURES_SQL = """
+    SELECT message_id, cluster_id, signature FROM near_dup_signatures
+    WHERE message_id IN (SELECT value FROM json_each(?))
+"""
+SIGNATURE_INSERT_SQL = "INSERT OR REPLACE INTO near_dup_signatures (message_id, cluster_id, signature) VALUES (?, ?, ?)"
+BAND_INSERT_SQL = "INSERT OR IGNORE INTO near_dup_bands (band_key, message_id) VALUES (?, ?)"
+CLUSTERS_SQL = """
+    SELECT message_id, cluster_id FROM near_dup_signatures
+    WHERE message_id IN (SELECT value FROM json_each(?))
+"""
+CLUSTER_LABELS_SQL = """
+    SELECT s.cluster_id, m.type, COUNT(*) AS n
+    FROM near_dup_signatures s JOIN messages m ON m.id = s.message_id
+    WHERE s.cluster_id IN (SELECT value FROM json_each(?)) AND m.type IS NOT NULL
+    GROUP BY s.cluster_id, m.type
+    ORDER BY n
+"""
+
+INDEXED = metrics.counter("near_dup_indexed_total", "Messages added to the near-duplicate index, by outcome")
+
+
+def normalize(text):
+    """
+    ASCII, casefolded words: accents and emoji are dropped and every number
+    becomes '0', so prices and phone numbers don't count.
+    """
+    text = unicodedata.normalize("NFKD", text[:MAX_CHARS].casefold()).encode("ascii", "ignore").decode()
+    return NON_WORD.sub(" ", DIGITS.sub("0", text)).strip()
+
+
+def signature(text):
+    """
+    MinHash signature (NUM_PERM uint32) of the character shingles of a
+    normalized text, or None if it is shorter than MIN_CHARS.
+    """
+    if len(text) < MIN_CHARS:
+        return None
+    # The SHINGLE bytes of every window packed into one integer (5 ASCII bytes fit in 40 bits)
+    codes = np.frombuffer(text.encode("ascii"), dtype=np.uint8).astype(np.uint64)
+    windows = len(codes) - SHINGLE + 1
+    packed = codes[:windows].copy()
+    for offset in range(1, SHINGLE):
+        packed = (packed << np.uint64(8)) | codes[offset:offset + windows]
+    shingles = np.unique(packed) % SHINGLE_PRIME
+    hashes = (shingles[:, None] * PERM_A + PERM_B) % PRIME
+    return hashes.min(axis=0).astype(np.uint32)
+
+
+def band_keys(sig):
+    """One signed 64-bit key per band; each band has its own multipliers, so bands don't collide."""
+    mixed = (sig.reshape(BANDS, ROWS).astype(np.uint64) * BAND_MIX).sum(axis=1, dtype=np.uint64)
+    return mixed.view(np.int64).tolist()
+
+
+def similarities(sig, candidates):
+    """Estimated Jaccard similarity of a signature to each row of `candidates`."""
+    return np.count_nonzero(candidates == sig, axis=1) / NUM_PERM
+
+
+def _json_list(values):
+    return json.dumps(list(values))
+
+
+def get_indexed_id(conn):
+    row = conn.execute(INDEXED_ID_SQL).fetchone()
+    return row[0] if row else 0
+
+
+def index_new(conn, page_size=PAGE_SIZE, verbose=True):
+    """
+    Indexes messages with an id above the stored high-water mark, one page
+    per transaction, so an interrupted run resumes where it stopped.
+    Returns (messages indexed, messages that joined an existing cluster).
+    """
+    c = conn.cursor()
+    last_id = get_indexed_id(conn)
+    indexed = joined = 0
+    started = time.perf_counter()
+    while True:
+        rows = c.execute(INDEX_PAGE_SQL, (last_id, page_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        entries = []
+        for message_id, content in rows:
+            sig = signature(normalize(content))
+            if sig is not None:
+                entries.append((message_id, sig, band_keys(sig)))
+
+        # Bands already in the index, with their message's cluster and signature
+        wanted = {key for _, _, keys in entries for key in keys}
+        buckets = dict(c.execute(BANDS_SQL, (_json_list(wanted),)))
+        known = {
+            message_id: (cluster_id, np.frombuffer(blob, dtype=np.uint32))
+            for message_id, cluster_id, blob in c.execute(SIGNATURES_SQL, (_json_list(set(buckets.values())),))
+        }
+
+        signature_rows, band_rows = [], []
+        for message_id, sig, keys in entries:
+            cluster_id = message_id
+            candidates = list({buckets[key] for key in keys if key in buckets})
+            if candidates:
+                scores = similarities(sig, np.stack([known[candidate][1] for candidate in candidates]))
+                best = int(scores.argmax())
+                if scores[best] >= SIMILARITY:
+                    cluster_id = known[candidates[best]][0]
+                    joined += 1
+            known[message_id] = (cluster_id, sig)
+            for key in keys:
+                if key not in buckets:
+                    buckets[key] = message_id
+                    band_rows.append((key, message_id))
+            signature_rows.append((message_id, cluster_id, sig.tobytes()))
+
+        c.executemany(SIGNATURE_INSERT_SQL, signature_rows)
+        c.executemany(BAND_INSERT_SQL, band_rows)
+        c.execute(INDEXED_ID_SET_SQL, (last_id,))
+        conn.commit()
+        indexed += len(signature_rows)
+
+    INDEXED.inc(joined, outcome="joined")
+    INDEXED.inc(indexed - joined, outcome="new_cluster")
+    if indexed and verbose:
+        print(f"Near-duplicate index: {indexed} messages indexed, {joined} joined an existing cluster"
+              f" ({time.perf_counter() - started:.1f}s)")
+    return indexed, joined
+
+
+def rebuild(conn):
+    """Drops the index; the next index_new starts from the first message."""
+    c = conn.cursor()
+    c.execute("DELETE FROM near_dup_signatures")
+    c.execute("DELETE FROM near_dup_bands")
+    c.execute("DELETE FROM meta WHERE key = 'near_dup_indexed'")
+    conn.commit()
+
+
+def get_clusters(conn, message_ids):
+    """{message_id: cluster_id} for the given messages that are in the index."""
+    c = conn.cursor()
+    c.execute(CLUSTERS_SQL, (_json_list(message_ids),))
+    return dict(c.fetchall())
+
+
+def get_cluster_labels(conn, cluster_ids):
+    """{cluster_id: type}: the most common label among the labeled members of each cluster."""
+    c = conn.cursor()
+    c.execute(CLUSTER_LABELS_SQL, (_json_list(cluster_ids),))
+    return {cluster_id: msg_type for cluster_id, msg_type, _ in c.fetchall()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the near-duplicate (MinHash LSH) index")
+    parser.add_argument("--rebuild", action="store_true", help="drop the index and index everything again")
+    parser.add_argument("--db", default="chat_data.db")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    connection = setup_database(args.db)
+    with metrics.instrumented(args, "near_dup"):
+        if args.rebuild:
+            rebuild(connection)
+        index_new(connection)
+    connection.close()
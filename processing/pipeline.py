@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from db import setup_database, database_path, source_name, iter_untagged_messages, BulkLoader, ResultWriter
+from split import ingestion_tasks, parse_range, map_ordered
+from aliases import ALIAS_INSERT_SQL, Anonymizer, alias_key
+from prefilter import Prefilter
+from async_deepseek_classifier import (
+    PAGE_SIZE, ClassificationCache, Progress, TokenUsage, label_page, pack_batches, run,
+)
+import metrics
+import near_dup
+
+# Runs the whole pipeline in one go, with the stages overlapping instead of
+# one full-table pass after another:
+#
+#   parse (processes) -> anonymize -> store -> classify (LLM)
+#
+# parse:     split.parse_range on byte ranges of the exports, sticker/media
+#            heuristic included
+# anonymize: sender names -> "Pessoa N" before anything is written
+# store:     BulkLoader in small transactions; after each commit the new
+#            rows join the near-duplicate index and the classifier may read them
+# classify:  the async classifier, following the committed untagged rows
+#
+# Stages are connected by bounded queues, so a slow stage holds back the
+# ones before it instead of buffering the whole file, and the run takes
+# about as long as the slowest stage. Everything is checkpointed in the DB
+# (source high-water marks, near-dup mark, untagged rows): after a crash,
+# running the same command again resumes where it stopped.
+#
+#   python pipeline.py cvs.txt outro_grupo.txt
+#
+# Files ingested by split.py without --anonymize (then maintenance.py
+# anonymize) have no stored aliases: re-reading them from the start is
+# refused unless --force, as their rows would be stored again.
+#
+# Aliases are keyed with ALIAS_KEY (see aliases.py).
+
+QUEUE_SIZE = 4                # Parsed chunks waiting between two stages
+CHUNK_MB = 1                  # Small chunks, so classification starts early
+ROWS_PER_TRANSACTION = 20000  # Rows become visible to the classifier per commit
+PAGE_WAIT = 5.0               # Seconds between polls for new rows if no commit is announced
+
+STAGE_WAIT = metrics.counter("pipeline_stage_wait_seconds_total",
+                             "Time a stage sat waiting for its input (high = upstream is the bottleneck)")
+STAGE_ITEMS = metrics.counter("pipeline_stage_messages_total", "Messages that went through a stage")
+
+
+def take(input_queue, stage):
+    """Next item of a stage's input queue, counting the time spent waiting for it."""
+    start = time.perf_counter()
+    item = input_queue.get()
+    STAGE_WAIT.inc(time.perf_counter() - start, stage=stage)
+    return item
+
+
+class CommittedRows:
+    """
+    Untagged rows the store stage has committed, handed to the classifier
+    page by page as they appear. next_page runs on a single reader thread.
+    """
+
+    def __init__(self, db_name):
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.condition = threading.Condition()
+        self.commits = 0
+        self.done = False
+        self.after_id = 0
+
+    def notify(self, done=False):
+        with self.condition:
+            self.commits += 1
+            self.done = self.done or done
+            self.condition.notify_all()
+
+    def next_page(self):
+        """Blocks until there are rows past the last page; None once ingestion is over and all were read."""
+        while True:
+            with self.condition:
+                seen, done = self.commits, self.done
+            page = list(itertools.islice(iter_untagged_messages(self.conn, self.after_id, PAGE_SIZE), PAGE_SIZE))
+            if page:
+                self.after_id = page[-1][0]
+                return page
+            if done:
+                return None
+            with self.condition:
+                self.condition.wait_for(lambda: self.commits != seen, timeout=PAGE_WAIT)
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_stage(tasks, workers, output):
+    try:
+        for (path, _, _), (rows, mark, _) in zip(tasks, map_ordered(parse_range, tasks, workers)):
+            STAGE_ITEMS.inc(len(rows), stage="parse")
+            output.put((path, rows, mark))
+    finally:
+        output.put(None)
+
+
+def anonymize_stage(anonymizer, input_queue, output):
+    try:
+        while (item := take(input_queue, "anonymize")) is not None:
+            path, rows, mark = item
+            rows = [(anonymizer.alias(ssn), *rest) for ssn, *rest in rows]
+            STAGE_ITEMS.inc(len(rows), stage="anonymize")
+            output.put((path, rows, mark, anonymizer.take_new()))
+    finally:
+        output.put(None)
+
+
+def store_stage(conn, input_queue, committed, resumed):
+    """Writes the anonymized rows; every commit updates the near-dup index and wakes the classifier."""
+    def on_commit(loader):
+        near_dup.index_new(conn, verbose=False)
+        committed.notify()
+
+    with BulkLoader(conn, rows_per_transaction=ROWS_PER_TRANSACTION, on_commit=on_commit) as loader:
+        for chat, last_timestamp in resumed.items():
+            loader.continue_source(chat, last_timestamp)
+        while (item := take(input_queue, "store")) is not None:
+            path, rows, mark, aliases = item
+            # Same transaction as the rows that use them
+            conn.executemany(ALIAS_INSERT_SQL, aliases)
+            chat = source_name(path)
+            for row in rows:
+                loader.add_normalized(*row, source=chat)
+            if mark:
+                loader.mark_source(os.path.abspath(path), *mark)
+            STAGE_ITEMS.inc(len(rows), stage="store")
+    return loader
+
+
+async def follow_batches(rows, cache, writer, progress, prefilter):
+    """Batches for the API from committed rows; ends once ingestion is over and everything was read."""
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(1, thread_name_prefix="pipeline-reader") as reader:
+        while (page := await loop.run_in_executor(reader, rows.next_page)) is not None:
+            progress.total += len(page)
+            for batch in pack_batches(label_page(page, cache, writer, progress, prefilter)):
+                yield batch
+
+
+def classify_stage(db_name, rows, use_prefilter):
+    # Own connection: the cache and prefilter read on the event loop's thread
+    conn = sqlite3.connect(db_name)
+    prefilter = Prefilter.from_db(conn) if use_prefilter else None
+    writer = ResultWriter(db_name)
+    writer.start()
+    cache = ClassificationCache(conn, writer)
+    progress = Progress(0)
+    usage = TokenUsage()
+    try:
+        asyncio.run(run(follow_batches(rows, cache, writer, progress, prefilter), writer, cache, progress, usage))
+    finally:
+        writer.close()
+        rows.close()
+        conn.close()
+    progress.report()
+    cache.report()
+    usage.report()
+    if prefilter:
+        prefilter.report()
+    if progress.dead:
+        print(f"{progress.dead} messages moved to dead_letters (see the table for errors)")
+
+
+class Stage(threading.Thread):
+    """Daemon thread that keeps the exception of its target, for run_pipeline to re-raise."""
+
+    def __init__(self, name, target, *args):
+        super().__init__(name=f"pipeline-{name}", daemon=True)
+        self.target, self.args, self.error = target, args, None
+
+    def run(self):
+        try:
+            with metrics.profiled_thread():
+                self.target(*self.args)
+        except Exception as e:
+            self.error = e
+            print(f"{self.name} stopped: {e}")
+
+
+def run_pipeline(conn, paths, workers=1, chunk_size=CHUNK_MB * 1024 * 1024, full=False,
+                 classify=True, use_prefilter=True, force=False):
+    """
+    Ingests, anonymizes and classifies `paths` with overlapping stages (see
+    the top of this file). Files resume from their high-water mark unless
+    `full` is set; the untagged backlog already in the DB is classified too.
+    See split.ingestion_tasks for `force`.
+    """
+    anonymizer = Anonymizer(conn, alias_key())  # refuses to start without the right key
+    db_name = database_path(conn)
+    tasks, resumed = ingestion_tasks(conn, paths, not full, chunk_size, keep_names=False, force=force)
+
+    parsed, anonymized = queue.Queue(QUEUE_SIZE), queue.Queue(QUEUE_SIZE)
+    committed = CommittedRows(db_name)
+    stages = [
+        Stage("parse", parse_stage, tasks, workers, parsed),
+        Stage("anonymize", anonymize_stage, anonymizer, parsed, anonymized),
+    ]
+    if classify:
+        stages.append(Stage("classify", classify_stage, db_name, committed, use_prefilter))
+    for stage in stages:
+        stage.start()
+
+    try:
+        loader = store_stage(conn, anonymized, committed, resumed)
+        print(f"Stored {loader.inserted} new messages ({loader.skipped} already in the database).")
+    finally:
+        # The classifier finishes what was committed, even after an error
+        committed.notify(done=True)
+        if classify:
+            stages[-1].join()
+        else:
+            committed.close()
+    for stage in stages:
+        stage.join()  # parse and anonymize are done once store saw their end
+
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest, anonymize and classify exports with overlapping stages")
+    parser.add_argument("paths", nargs="*", default=["cvs.txt"], help="one export per chat")
+    parser.add_argument("--full", action="store_true",
+                        help="re-read the exports from the start instead of resuming (stored rows are skipped)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes")
+    parser.add_argument("--chunk-mb", type=int, default=CHUNK_MB,
+                        help="exports are parsed (and committed) in chunks of this size")
+    parser.add_argument("--force", action="store_true",
+                        help="re-read files even if that stores the messages of some senders again")
+    parser.add_argument("--no-classify", action="store_true", help="stop after storing and indexing")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="send everything the cache can't answer to the LLM")
+    parser.add_argument("--db", default="chat_data.db")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"Starting pipeline at {datetime.now().strftime('%H:%M:%S')}")
+    connection = setup_database(args.db)
+    with metrics.instrumented(args, "pipeline"):
+        run_pipeline(connection, args.paths, args.workers, args.chunk_mb * 1024 * 1024, args.full,
+                     classify=not args.no_classify, use_prefilter=not args.no_prefilter, force=args.force)
+    connection.close()
+    print(f"Finished at {datetime.now().strftime('%H:%M:%S')}")
@@ -0,0 +1,246 @@
+import math
+import os
+import random
+import re
+import unicodedata
+from collections import defaultdict
+
+from db import get_training_messages
+
+# Local tier in front of the LLM. Each tier answers (type, confidence) or
+# None; the first answer at or above its threshold wins, and only messages
+# nobody is sure about are sent to DeepSeek.
+
+CATEGORIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "categorias.txt")
+CATEGORY_LINE = re.compile(r"^\s*(\d{2}) -> (.+)$")
+
+
+def load_categories(path=CATEGORIES_FILE):
+    """Reads {code: description} from categorias.txt."""
+    categories = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            match = CATEGORY_LINE.match(line)
+            if match:
+                categories[int(match.group(1))] = match.group(2).strip()
+    return categories
+
+
+def strip_accents(text):
+    """casefold + remove diacritics, so rules can be written in plain ASCII."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def detect_type(content):
+    """Cheap local heuristic for stickers (4) and media (5)."""
+    if "STK" in content and ".webp" in content:
+        return 4
+    if content.endswith("<Mídia oculta>") or content.endswith("(arquivo anexado)"):
+        return 5
+    return None
+
+
+# detect_type as SQL, for set-based re-tagging (maintenance.py).
+# GLOB is case-sensitive like the str checks above; keep both in sync.
+STICKER_SQL = "(content GLOB '*STK*' AND content GLOB '*.webp*')"
+MEDIA_SQL = "(content GLOB '*<Mídia oculta>' OR content GLOB '*(arquivo anexado)')"
+DETECT_TYPE_SQL = f"(CASE WHEN {STICKER_SQL} THEN 4 WHEN {MEDIA_SQL} THEN 5 END)"
+
+
+class HeuristicTier:
+    """Stickers and media, recognized by the export's placeholders."""
+    name = "heuristic"
+
+    def predict(self, text):
+        msg_type = detect_type(text)
+        return (msg_type, 1.0) if msg_type is not None else None
+
+
+# code -> list of rules; a rule is a tuple of patterns that must ALL match
+# the accent-stripped, casefolded text. Only high-precision phrasings
+# belong here: anything ambiguous is left to the model or the LLM.
+RULES = {
+    1: [
+        (r"\b(alguem|alg)\b.{0,30}\bfez prova\b",),
+        (r"\bprova (do|da|com) (o |a )?(prof|professor|professora)\b",),
+    ],
+    2: [
+        (r"\b(alguem tem|passa|me passa|preciso d[oa])\b",
+         r"\b(contato|wpp|whats|whatsapp|zap|telefone|numero) d[oae]s?\b"),
+    ],
+    3: [
+        (r"^(tem )?alguem (no|na|em) (hucff|hu|upa|fundao|evandro|ipub|ippmg|iieg|hesfa|maternidade)\b",),
+    ],
+    7: [
+        (r"\bliga\b", r"\b(processo seletivo|aula (aberta|inaugural)|sessao aberta|inscricoes abertas)\b"),
+    ],
+    9: [
+        (r"\b(vendo|compro|repasso|vendendo)\b.{0,30}\bingressos?\b",),
+    ],
+    10: [
+        (r"\b(vendo|compro|divido|dividir|compartilhar)\b",
+         r"\b(medcurso|medway|sanar|whitebook|medcel|medcof|aristo|estrategia med|guyton|netter|robbins|harrison|sobotta)\b"),
+    ],
+}
+
+
+class RuleTier:
+    """Keyword/regex rules per category (see RULES)."""
+    name = "rule"
+
+    def __init__(self, rules=RULES, confidence=0.95):
+        unknown = set(rules) - set(load_categories())
+        if unknown:
+            raise ValueError(f"Rules for categories missing from categorias.txt: {sorted(unknown)}")
+        self.confidence = confidence
+        self.rules = [
+            (code, [re.compile(pattern) for pattern in patterns])
+            for code, alternatives in rules.items()
+            for patterns in alternatives
+        ]
+
+    def predict(self, text):
+        plain = strip_accents(text)
+        for code, patterns in self.rules:
+            if all(pattern.search(plain) for pattern in patterns):
+                return code, self.confidence
+        return None
+
+
+TOKEN = re.compile(r"\w+")
+
+
+class NaiveBayesTier:
+    """
+    Multinomial Naive Bayes over hashed word uni+bigrams, i.e. a linear
+    classifier in log space, trained on rows already labeled by the LLM.
+    Its confidence threshold is calibrated on a held-out split so that the
+    answers it keeps reach `target_precision`.
+    """
+    name = "model"
+
+    def __init__(self, buckets=2 ** 20, alpha=0.1):
+        self.buckets = buckets
+        self.alpha = alpha
+        self.class_counts = {}
+        self.feature_counts = {}
+        self.feature_totals = {}
+        self.vocabulary = 1
+        self.threshold = math.inf
+
+    def features(self, text):
+        words = TOKEN.findall(strip_accents(text))
+        grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        return [hash(gram) % self.buckets for gram in grams]
+
+    def fit(self, texts, labels):
+        class_counts = defaultdict(int)
+        feature_counts = defaultdict(lambda: defaultdict(int))
+        seen = set()
+        for text, label in zip(texts, labels):
+            class_counts[label] += 1
+            counts = feature_counts[label]
+            for feature in self.features(text):
+                counts[feature] += 1
+                seen.add(feature)
+
+        self.class_counts = dict(class_counts)
+        self.feature_counts = {label: dict(counts) for label, counts in feature_counts.items()}
+        self.feature_totals = {label: sum(counts.values()) for label, counts in self.feature_counts.items()}
+        self.vocabulary = max(len(seen), 1)
+        return self
+
+    def predict(self, text):
+        if not self.class_counts:
+            return None
+        features = self.features(text)
+        if not features:
+            return None
+
+        documents = sum(self.class_counts.values())
+        scores = {}
+        for label, count in self.class_counts.items():
+            counts = self.feature_counts[label]
+            denominator = math.log(self.feature_totals[label] + self.alpha * self.vocabulary)
+            score = math.log(count / documents)
+            for feature in features:
+                score += math.log(counts.get(feature, 0) + self.alpha) - denominator
+            scores[label] = score
+
+        best = max(scores, key=scores.get)
+        # softmax probability of the winning class
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+    def calibrate(self, texts, labels, target_precision=0.95, min_support=50):
+        """
+        Picks the lowest confidence whose predictions at or above it are
+        still `target_precision` correct on held-out data. If no threshold
+        with at least `min_support` predictions qualifies, the model stays
+        disabled (threshold = inf).
+        """
+        predictions = []
+        for text, label in zip(texts, labels):
+            predicted = self.predict(text)
+            if predicted is not None:
+                predictions.append((predicted[1], predicted[0] == label))
+        predictions.sort(reverse=True)
+
+        correct = 0
+        self.threshold = math.inf
+        for kept, (confidence, is_correct) in enumerate(predictions, start=1):
+            correct += is_correct
+            if kept >= min_support and correct / kept >= target_precision:
+                self.threshold = confidence
+        return self.threshold
+
+
+class Prefilter:
+    """
+    Runs the tiers in order. classify() returns (type, tier name) for
+    confident answers and None when the message should go to the LLM.
+    """
+
+    def __init__(self, tiers, threshold=0.9):
+        self.tiers = tiers
+        self.threshold = threshold
+        self.resolved = defaultdict(int)
+        self.passed = 0
+
+    def classify(self, text):
+        for tier in self.tiers:
+            predicted = tier.predict(text)
+            if predicted is None:
+                continue
+            msg_type, confidence = predicted
+            if confidence >= max(self.threshold, getattr(tier, "threshold", 0)):
+                self.resolved[tier.name] += 1
+                return msg_type, tier.name
+        self.passed += 1
+        return None
+
+    def report(self):
+        total = sum(self.resolved.values()) + self.passed
+        if total:
+            local = ", ".join(f"{count} by {name}" for name, count in self.resolved.items()) or "none"
+            print(f"Prefilter: resolved {total - self.passed}/{total} locally ({local})")
+
+    @classmethod
+    def from_db(cls, conn, threshold=0.9, target_precision=0.95, training_limit=200000):
+        """Rules + a Naive Bayes model trained on the LLM labels already in the DB."""
+        tiers = [HeuristicTier(), RuleTier()]
+
+        rows = get_training_messages(conn, limit=training_limit)
+        if rows:
+            random.Random(0).shuffle(rows)
+            split = len(rows) * 9 // 10
+            model = NaiveBayesTier().fit(*zip(*rows[:split]))
+            if split < len(rows):
+                model.calibrate(*zip(*rows[split:]), target_precision=target_precision)
+            print(f"Prefilter model trained on {split} labeled messages; "
+                  f"confidence threshold {model.threshold:.3f} for {target_precision:.0%} precision")
+            if model.threshold != math.inf:
+                tiers.append(model)
+
+        return cls(tiers, threshold)
@@ -1,35 +1,271 @@
+import argparse
+import os
 import re
-from db import setup_database, store_message
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
+from db import (
+    setup_database, get_source, content_hash, normalize_timestamp, source_name,
+    BulkLoader, TIMESTAMP_FORMATS,
+)
+from aliases import ALIAS_INSERT_SQL, Anonymizer, alias_key, orphan_senders
+import metrics
+import near_dup
+from prefilter import detect_type
 
-connection = setup_database()
-with open('cvs.txt', 'r', encoding='utf-8') as file:
-    content = file.read()
-    result = re.split(r"\d{2}\/\d{2}\/\d{4} \d{2}:\d{2} - ", content)
-    timestamps = re.findall(r"\d{2}\/\d{2}\/\d{4} \d{2}:\d{2} - ", content)
-    result.pop(0)
+PARSE_SECONDS = metrics.histogram("ingest_parse_seconds", "Time a parser process spent on one chunk")
+PARSED_BYTES = metrics.counter("ingest_parsed_bytes_total", "Bytes of export files parsed")
+PARSED_MESSAGES = metrics.counter("ingest_parsed_messages_total", "Messages parsed from export files")
+PARSER_WAIT = metrics.counter("ingest_parser_wait_seconds_total",
+                              "Time the writer sat waiting for parsed chunks (high = parser-bound)")
 
-    for i in range(len(result)):
-        s = result[i]
-        if ":" in s:
-            userName = s.split(": ")[0]
-            content = s.split(": ")[1][:-1]
+# A new message starts with "DD/MM/YYYY HH:MM - " at the beginning of a line
+# (some export locales write 2-digit years and/or seconds).
+# Anything else is a continuation of the previous (multi-line) message.
+MESSAGE_START = re.compile(r"(\d{2}/\d{2}/(?:\d{4}|\d{2}) \d{2}:\d{2}(?::\d{2})?) - ")
 
+# offset/end are the byte range of the message in the export file
+ChatMessage = namedtuple("ChatMessage", "user timestamp content type offset end")
+
+
+def iter_raw_messages(file, start=0, stop=None):
+    """
+    Groups the lines of a binary file object into (offset, end, timestamp, body)
+    tuples, starting at byte `start`. Continuation lines are joined to the
+    message they belong to, so only the message currently being assembled is
+    ever held in memory. With `stop`, only messages starting before that byte
+    are returned (see message_boundaries).
+    """
+    file.seek(start)
+    position = start
+    offset = None
+    timestamp = None
+    parts = []
+    for raw in file:
+        line = raw.decode('utf-8', errors='replace')
+        match = MESSAGE_START.match(line)
+        if match:
+            if timestamp is not None:
+                yield offset, position, timestamp, "".join(parts)
+            if stop is not None and position >= stop:
+                return
+            offset = position
+            timestamp = match.group(1)
+            parts = [line[match.end():]]
+        elif timestamp is not None:
+            parts.append(line)
+        position += len(raw)
+    if timestamp is not None:
+        yield offset, position, timestamp, "".join(parts)
+
+
+def iter_messages(path, start=0, stop=None):
+    """
+    Streams a WhatsApp export from byte `start` (up to `stop`) and yields a
+    ChatMessage for every user message. System lines (no "user: " prefix)
+    and empty messages are skipped.
+    """
+    with open(path, 'rb') as file:
+        for offset, end, timestamp, body in iter_raw_messages(file, start, stop):
+            userName, sep, content = body.partition(": ")
+            if not sep:
+                continue
+
+            content = content.rstrip("\r\n")
             if len(content) == 0:
                 continue
 
-            type = None
-            if "STK" in content and ".webp" in content:
-                type = 4
-            elif content.endswith("<Mídia oculta>") or content.endswith("(arquivo anexado)"):
-                type = 5
+            yield ChatMessage(userName, timestamp, content, detect_type(content), offset, end)
+
+
+def message_hash(message):
+    return content_hash(f"{message.timestamp}|{message.user}|{message.content}")
+
+
+def resume_offset(conn, path):
+    """
+    Where an incremental ingestion of `path` should start reading.
+
+    The stored high-water mark is only trusted if the last message ingested
+    is still found, unchanged, right before it. Otherwise (new export of a
+    different chat, edited or truncated file) the whole file is re-read and
+    the (user, timestamp, content hash, occurrence) uniqueness key skips
+    stored rows.
+    """
+    source = get_source(conn, os.path.abspath(path))
+    if source is None:
+        return 0
+
+    offset, last_offset, last_timestamp, last_hash = source
+    if os.path.getsize(path) < offset:
+        return 0
+
+    last = next(iter_messages(path, last_offset), None)
+    if last is None or last.end != offset or message_hash(last) != last_hash:
+        print(f"{path} changed before the stored high-water mark, re-reading it entirely")
+        return 0
+    return offset
+
+
+def message_boundaries(path, start=0, chunk_size=16 * 1024 * 1024):
+    """
+    Splits `path` from byte `start` into (start, stop) ranges of about
+    `chunk_size` bytes, cut right before a line that starts a message, so
+    every range can be parsed on its own. The last range has stop=None.
+    """
+    bounds = [start]
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        while bounds[-1] + chunk_size < size:
+            file.seek(bounds[-1] + chunk_size)
+            file.readline()  # most likely the middle of a line
+            while True:
+                position = file.tell()
+                raw = file.readline()
+                if not raw:
+                    return list(zip(bounds, bounds[1:] + [None]))
+                if MESSAGE_START.match(raw.decode('utf-8', errors='replace')):
+                    bounds.append(position)
+                    break
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def parse_range(path, start, stop):
+    """
+    Worker side of a parallel ingestion: parses one byte range and does all
+    per-message CPU work (timestamp normalization, heuristics, hashing).
+    Returns the rows for BulkLoader.add_normalized, the source mark of the
+    last message of the range (None if it had no messages) and the seconds
+    spent parsing.
+    """
+    start_time = time.perf_counter()
+    rows = []
+    last = None
+    for message in iter_messages(path, start, stop):
+        try:
+            iso_timestamp = normalize_timestamp(message.timestamp)
+        except ValueError as e:
+            print(f"Timestamp Error: {e} | Format must be {TIMESTAMP_FORMATS}")
+            continue
+        rows.append((message.user, iso_timestamp, message.content, message.type,
+                     content_hash(message.content)))
+        last = message
+    mark = last and (last.end, last.offset, last.timestamp, message_hash(last))
+    return rows, mark, time.perf_counter() - start_time
+
+
+def map_ordered(function, tasks, workers):
+    """
+    Runs function(*task) for every task on `workers` processes and yields
+    the results in task order. At most 2 * workers results are pending, so
+    memory stays bounded when the consumer (the DB writer) is slower.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(function, *task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ingestion_tasks(conn, paths, incremental, chunk_size, keep_names=True, force=False):
+    """
+    (path, start, stop) byte ranges to parse for `paths`, from their
+    high-water mark if `incremental`, and {chat: ISO timestamp of its last
+    stored message} for the files that resume (see BulkLoader.continue_source).
+
+    A file read from the start is refused, unless `force`, if its chat has
+    senders this run can't store under the same name again (aliases when
+    `keep_names`, else real names and aliases without a stored hash): the
+    dedup key includes the user, so all their messages would be stored twice.
+    """
+    tasks, resumed = [], {}
+    for path in paths:
+        start = resume_offset(conn, path) if incremental else 0
+        if not start and not force:
+            orphans = orphan_senders(conn, source_name(path), keep_names)
+            if orphans:
+                kind = "aliases" if keep_names else "real names or aliases without a stored hash"
+                raise SystemExit(
+                    f"Refusing to re-read {path}: {orphans} of its senders are stored as {kind}, which this run"
+                    " won't give them again, so their messages would be stored twice."
+                    " Pass --force to re-read it anyway.")
+        if start:
+            print(f"Resuming {path} at byte {start}")
+            last_timestamp = get_source(conn, os.path.abspath(path))[2]
+            resumed[source_name(path)] = normalize_timestamp(last_timestamp)
+        tasks += [(path, begin, end) for begin, end in message_boundaries(path, start, chunk_size)]
+    return tasks, resumed
+
+
+def ingest(conn, paths, incremental=False, workers=1, chunk_size=16 * 1024 * 1024, index_near_dups=True,
+           anonymizer=None, force=False):
+    """
+    Ingests one or more exports. Files are cut into byte ranges that are
+    parsed in parallel by `workers` processes; all rows go through a single
+    BulkLoader, in file order, so each file's high-water mark stays exact.
+    Every file is stored as its own chat (messages.source). With an
+    `anonymizer` (aliases.Anonymizer), senders are stored under their alias.
+    New messages are then added to the near-duplicate index unless
+    `index_near_dups` is off. See ingestion_tasks for `force`.
+    """
+    tasks, resumed = ingestion_tasks(conn, paths, incremental, chunk_size, anonymizer is None, force)
+
+    with BulkLoader(conn) as loader:
+        for chat, last_timestamp in resumed.items():
+            loader.continue_source(chat, last_timestamp)
+        results = map_ordered(parse_range, tasks, workers)
+        for path, begin, end in tasks:
+            waited = time.perf_counter()
+            rows, mark, seconds = next(results)
+            PARSER_WAIT.inc(time.perf_counter() - waited)
+            PARSE_SECONDS.observe(seconds)
+            PARSED_BYTES.inc((end or os.path.getsize(path)) - begin)
+            PARSED_MESSAGES.inc(len(rows))
+
+            if anonymizer:
+                rows = [(anonymizer.alias(ssn), *rest) for ssn, *rest in rows]
+                # Same transaction as the rows that use them
+                conn.executemany(ALIAS_INSERT_SQL, anonymizer.take_new())
+            chat = source_name(path)
+            for row in rows:
+                loader.add_normalized(*row, source=chat)
+            if mark:
+                loader.mark_source(os.path.abspath(path), *mark)
+
+    print(f"Stored {loader.inserted} new messages ({loader.skipped} already in the database).")
+    if index_near_dups:
+        # New messages join their campaign clusters right away (see near_dup.py)
+        near_dup.index_new(conn)
 
-            time = timestamps[i][0:16]
-            store_message(connection, userName, time, content, type)
 
-# Verify the stored ISO format
-# cursor = connection.cursor()
-# cursor.execute("SELECT timestamp, content FROM messages")
-# print("Stored Data:", cursor.fetchall())
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest WhatsApp exports into the database")
+    parser.add_argument("paths", nargs="*", default=["cvs.txt"], help="one export per chat")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only read what was appended since the last run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="parser processes (default: one per core)")
+    parser.add_argument("--chunk-mb", type=int, default=16,
+                        help="large files are parsed in chunks of this size")
+    parser.add_argument("--anonymize", action="store_true",
+                        help="store senders as \"Pessoa N\" with pipeline.py's aliases (needs ALIAS_KEY)")
+    parser.add_argument("--force", action="store_true",
+                        help="re-read files even if that stores the messages of some senders again")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
 
-connection.close()
\ No newline at end of file
+    with metrics.instrumented(args, "ingest"):
+        connection = setup_database()
+        anonymizer = Anonymizer(connection, alias_key()) if args.anonymize else None
+        ingest(connection, args.paths, args.incremental, args.workers, args.chunk_mb * 1024 * 1024,
+               anonymizer=anonymizer, force=args.force)
+        connection.close()
@@ -0,0 +1,116 @@
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+# Generates a fake WhatsApp export in the same format as cvs.txt, to
+# benchmark the pipeline at any size without real (personal) data:
+#
+#   python synthetic_export.py synthetic.txt --messages 1000000 --users 300
+#
+# The mix is configurable: multi-line messages, stickers, hidden media,
+# spam campaigns re-posted word for word (what the cache and near-duplicate
+# detection feed on) and ordinary chat built from a small vocabulary.
+
+HEADER = ("As mensagens e ligações são protegidas com a criptografia de ponta a ponta "
+          "e ficam somente entre você e os participantes desta conversa.")
+
+SYSTEM_LINES = [
+    "{user} entrou usando o link de convite deste grupo",
+    "{user} saiu",
+    "{user} mudou a descrição do grupo",
+]
+
+CHAT_OPENINGS = [
+    "alguém sabe", "gente", "pessoal", "bom dia", "boa tarde", "alguém tem",
+    "alguém já fez prova com o professor", "tem alguém no", "preciso do contato do",
+    "quem vai", "alguém vai no", "vocês viram",
+]
+
+CHAT_WORDS = [
+    "prova", "plantão", "hucff", "fundão", "anatomia", "fisiologia", "farmaco",
+    "residente", "internato", "aula", "amanhã", "hoje", "sala", "bloco", "ônibus",
+    "bandejão", "biblioteca", "cirurgia", "pediatria", "clínica", "médica",
+    "resumo", "slide", "gabarito", "horário", "turma", "estágio", "ambulatório",
+    "wpp", "grupo", "calouro", "festa", "ingresso", "liga", "curso", "apostila",
+]
+
+SPAM_CAMPAIGNS = [
+    "🚨 VENDO INGRESSO PARA A CALOURADA DA MEDICINA 🚨\nChama no privado, últimas unidades!",
+    "A Liga Acadêmica de Cardiologia está com INSCRIÇÕES ABERTAS para o processo seletivo!\nAula inaugural dia 15, link na bio.",
+    "Compartilho Medcurso 2024 completo, valor simbólico. Interessados chamar no pv",
+    "Alugo quarto mobiliado perto do Fundão, R$ 900 com contas inclusas.\nFotos no privado.",
+    "FESTA DO JALECO 🥳 sexta-feira, open bar até meia-noite\nIngressos com a comissão",
+    "Vendo Guyton e Netter seminovos, aceito pix",
+]
+
+
+def phone_number(rng):
+    return f"+55 21 9{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}"
+
+
+def chat_text(rng, multiline):
+    words = rng.sample(CHAT_WORDS, rng.randint(2, 8))
+    text = f"{rng.choice(CHAT_OPENINGS)} {' '.join(words)}{rng.choice(['?', '', '!', ' kkkk'])}"
+    if multiline:
+        extra = [" ".join(rng.sample(CHAT_WORDS, rng.randint(1, 5))) for _ in range(rng.randint(1, 3))]
+        text = "\n".join([text, *extra])
+    return text
+
+
+def generate(path, messages, users=200, multiline=0.05, stickers=0.08, media=0.10,
+             spam=0.05, system=0.002, two_digit_year=False, start=datetime(2024, 1, 1), seed=0):
+    """
+    Writes an export with `messages` user messages (plus a few system lines)
+    to `path`. Ratios are fractions of all messages. Returns the size of
+    the file in bytes.
+    """
+    rng = random.Random(seed)
+    names = [phone_number(rng) for _ in range(users)]
+    date_format = "%d/%m/%y %H:%M" if two_digit_year else "%d/%m/%Y %H:%M"
+    now = start
+
+    with open(path, "w", encoding="utf-8", newline="\n") as out:
+        out.write(f"{now.strftime(date_format)} - {HEADER}\n")
+        for index in range(messages):
+            # Chats are bursty: most messages share the minute of the previous one
+            if rng.random() > 0.6:
+                now += timedelta(minutes=int(rng.expovariate(1 / 20)) + 1)
+            stamp = now.strftime(date_format)
+            user = rng.choice(names)
+
+            if rng.random() < system:
+                out.write(f"{stamp} - {rng.choice(SYSTEM_LINES).format(user=user)}\n")
+
+            kind = rng.random()
+            if kind < stickers:
+                content = f"STK-{now:%Y%m%d}-WA{index % 10000:04d}.webp (arquivo anexado)"
+            elif kind < stickers + media:
+                content = rng.choice(["<Mídia oculta>", f"IMG-{now:%Y%m%d}-WA{index % 10000:04d}.jpg (arquivo anexado)"])
+            elif kind < stickers + media + spam:
+                content = rng.choice(SPAM_CAMPAIGNS)
+            else:
+                content = chat_text(rng, rng.random() < multiline)
+            out.write(f"{stamp} - {user}: {content}\n")
+    # Not the sum of out.write(): text mode counts characters, and accents/emoji take several bytes
+    return os.path.getsize(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic WhatsApp export")
+    parser.add_argument("path", nargs="?", default="synthetic.txt")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--multiline", type=float, default=0.05, help="fraction of multi-line chat messages")
+    parser.add_argument("--stickers", type=float, default=0.08)
+    parser.add_argument("--media", type=float, default=0.10)
+    parser.add_argument("--spam", type=float, default=0.05, help="fraction of re-posted spam campaigns")
+    parser.add_argument("--system", type=float, default=0.002,
+                        help="chance of a system line (join/leave) before each message")
+    parser.add_argument("--two-digit-year", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    size = generate(args.path, args.messages, args.users, args.multiline, args.stickers,
+                    args.media, args.spam, args.system, args.two_digit_year, seed=args.seed)
+    print(f"Wrote {args.messages} messages ({size / (1024 * 1024):.1f} MB) to {args.path}")
@@ -0,0 +1,82 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+from openai import AuthenticationError
+
+import async_deepseek_classifier as classifier
+import fake_llm_server
+from db import setup_database, database_path, ResultWriter
+
+
+def start_server(monkeypatch, **options):
+    """fake_llm_server on a free port, with the classifier pointed at it."""
+    server = fake_llm_server.serve("127.0.0.1", 0, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(classifier, "BASE_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(classifier, "API_KEY", "fake")
+    return server
+
+
+@pytest.fixture
+def rejecting_server(monkeypatch):
+    """Answers every request with a 401, like a revoked API key."""
+    server = start_server(monkeypatch, reject=True)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def llm_server(monkeypatch):
+    server = start_server(monkeypatch, latency=0.05)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_rejected_api_key_stops_the_run(tmp_path, monkeypatch, rejecting_server):
+    # More batches than workers plus queue slots: the producer used to block
+    # on the full queue forever once every worker had died on the 401
+    monkeypatch.setattr(classifier, "QUEUE_SIZE", 2)
+    conn = setup_database(str(tmp_path / "chat_data.db"))
+    writer = ResultWriter(database_path(conn))
+    writer.start()
+    cache = classifier.ClassificationCache(conn, writer, near_dups=False)
+    batches = ([classifier.make_item(i, f"mensagem {i}")] for i in range(100))
+    run = classifier.run(batches, writer, cache, classifier.Progress(100), classifier.TokenUsage(), concurrency=5)
+    try:
+        with pytest.raises(AuthenticationError):
+            asyncio.run(asyncio.wait_for(run, timeout=30))
+    finally:
+        writer.close()
+        conn.close()
+
+
+def add_messages(conn, count):
+    user_id = conn.execute("INSERT INTO users (ssn) VALUES ('Pessoa 1')").lastrowid
+    conn.executemany(
+        "INSERT INTO messages (user_id, timestamp, content, content_hash, source, occurrence)"
+        " VALUES (?, ?, ?, ?, 'chat', 0)",
+        ((user_id, f"2024-01-01 {i // 60 % 24:02d}:{i % 60:02d}:00", f"mensagem número {i}", str(i))
+         for i in range(count)))
+    conn.commit()
+
+
+def test_failed_write_stops_the_run(tmp_path, llm_server):
+    conn = setup_database(str(tmp_path / "chat_data.db"))
+    add_messages(conn, 5000)
+    # No tables in this one: the first flush fails
+    writer = ResultWriter(str(tmp_path / "empty.db"), flush_interval=0.01)
+    writer.start()
+    cache = classifier.ClassificationCache(conn, writer, near_dups=False)
+    progress = classifier.Progress(5000)
+    batches = classifier.iter_batches(conn, cache, writer, progress)
+    run = classifier.run(batches, writer, cache, progress, classifier.TokenUsage(), concurrency=5)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            asyncio.run(asyncio.wait_for(run, timeout=30))
+        assert progress.classified < 2500  # stopped at the first failed flush, not after the backlog
+    finally:
+        conn.close()